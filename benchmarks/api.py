@@ -0,0 +1,325 @@
+"""
+Load benchmark of the API endpoints against seeded data.
+
+Builds the app with `core.app.create_app`, seeds the database and drives
+concurrent requests through an in-process ASGI client, reporting the
+throughput, latency percentiles and queries per request of each endpoint:
+
+    python -m benchmarks.api --procedures 100000 --output before.json
+
+Runs against a throwaway SQLite database by default. Pass `--db-url` to
+use Postgres; its tables are DROPPED and recreated, so only point it to a
+dedicated database. Diff the JSON outputs of two commits to compare them.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+SCENARIOS = ("registry", "token", "daily", "glossed", "financial")
+PASSWORD = "benchmark"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db-url", help="Database url (default: temp SQLite)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--doctors", type=int, default=50, help="At least 2")
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--procedures", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=365, help="Spread of dates")
+    parser.add_argument("--requests", type=int, default=200, help="Per scenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--no-report-cache",
+        action="store_true",
+        help="Disable the report cache, to measure the report queries",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    return parser.parse_args()
+
+
+def configure_env(args: argparse.Namespace) -> None:
+    # read by the app modules on import
+    if args.db_url:
+        os.environ["DB_URL"] = args.db_url
+    else:
+        path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+        os.environ.setdefault("DB_URL", f"sqlite:///{path}")
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    if args.no_report_cache:
+        os.environ["REPORT_CACHE_SIZE"] = "0"
+
+
+def seed(args: argparse.Namespace, batch_size: int = 50000) -> None:
+    """
+    Recreate the tables and fill them with generated rows, inserted with
+    multi-row Core statements. Ids start from 1 in the new tables, and
+    doctor `i` belongs to user `i`.
+    """
+    from sqlalchemy import insert
+
+    from models.base import Base
+    from models.doctor import Doctor
+    from models.engine import get_engine, session_scope
+    from models.patient import Patient
+    from models.procedure import PAYMENT_STATUS, Procedure, ProcedureRollup
+    from models.user import User
+
+    Base.metadata.drop_all(bind=get_engine())
+    Base.metadata.create_all(bind=get_engine())
+
+    rng = random.Random(args.seed)
+    # hashing is slow on purpose, every user gets the same password
+    password = User.get_password_hash(PASSWORD)
+    users = max(args.users, args.doctors, 1)
+    today = datetime.combine(date.today(), datetime.min.time())
+
+    def procedures():
+        for _ in range(args.procedures):
+            yield {
+                "doctor_id": rng.randint(1, args.doctors),
+                "patient_id": rng.randint(1, args.patients),
+                "date": today - timedelta(days=rng.randrange(args.days)),
+                "value": round(rng.uniform(50, 1000), 2),
+                "payment_status": rng.choice(PAYMENT_STATUS.enums),
+            }
+
+    def batches(rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    with session_scope() as session:
+        session.execute(
+            insert(User),
+            [
+                {
+                    "username": f"user{i}",
+                    "password": password,
+                    # user 1 runs the superuser reports
+                    "is_superuser": i == 1,
+                }
+                for i in range(1, users + 1)
+            ],
+        )
+        session.execute(
+            insert(Doctor),
+            [
+                {"name": f"Doctor {i}", "user_id": i}
+                for i in range(1, args.doctors + 1)
+            ],
+        )
+        session.execute(
+            insert(Patient),
+            [{"name": f"Patient {i}"} for i in range(1, args.patients + 1)],
+        )
+        session.commit()
+
+        for batch in batches(procedures()):
+            session.execute(insert(Procedure), batch)
+            session.commit()
+
+        # core inserts skip the mapper events that keep the rollups
+        ProcedureRollup.rebuild()
+
+
+class QueryCounter:
+    def __init__(self, engines):
+        from sqlalchemy import event
+
+        self.count = 0
+        for engine in engines:
+            event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+
+def build_requests(args: argparse.Namespace, headers: dict) -> dict:
+    """
+    Get a function building the `client.request` kwargs of each scenario.
+    """
+    rng = random.Random(args.seed)
+    today = date.today()
+
+    def registry(i):
+        return {
+            "method": "POST",
+            "url": "/procedure/registry",
+            "headers": headers["doctor"],
+            "json": {
+                "doctor_id": 2,
+                "patient_id": rng.randint(1, args.patients),
+                "date": today.isoformat(),
+                "value": 100.0,
+                "payment_status": "pending",
+            },
+        }
+
+    def token(i):
+        return {
+            "method": "POST",
+            "url": "/auth/token",
+            "data": {"username": "user2", "password": PASSWORD},
+        }
+
+    def daily(i):
+        return {
+            "method": "GET",
+            "url": "/procedure/report/daily",
+            "headers": headers["admin"],
+            "params": {"doctor_id": rng.randint(1, args.doctors)},
+        }
+
+    def glossed(i):
+        start = today - timedelta(days=rng.randrange(args.days))
+        return {
+            "method": "POST",
+            "url": "/procedure/report/glossed",
+            "headers": headers["doctor"],
+            "json": {
+                "start": start.isoformat(),
+                "end": (start + timedelta(days=30)).isoformat(),
+            },
+        }
+
+    def financial(i):
+        return {
+            "method": "GET",
+            "url": f"/procedure/report/financial/{rng.randint(1, args.doctors)}",
+            "headers": headers["admin"],
+        }
+
+    scenarios = {
+        "registry": registry,
+        "token": token,
+        "daily": daily,
+        "glossed": glossed,
+        "financial": financial,
+    }
+    return {name: scenarios[name] for name in args.scenarios}
+
+
+async def run_scenario(client, build, counter, requests: int, concurrency: int):
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in pending:
+            kwargs = build(i)
+            started = time.perf_counter()
+            response = await client.request(**kwargs)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    counter.count = 0
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "queries_per_request": round(counter.count / requests, 2),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    import httpx
+
+    from core.app import create_app
+    from models.engine import DB_ASYNC, get_async_engine, get_engine
+    from models.user import User
+
+    app = create_app()
+    engines = [get_engine()] + ([get_async_engine().sync_engine] if DB_ASYNC else [])
+    counter = QueryCounter(engines)
+    headers = {
+        name: {
+            "Authorization": "Bearer "
+            + User.create_access_token(data={"sub": username})
+        }
+        # user 2 is a regular user, owner of doctor 2
+        for name, username in (("admin", "user1"), ("doctor", "user2"))
+    }
+    builders = build_requests(args, headers)
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as client:
+            for name, build in builders.items():
+                # warm up connections and caches before measuring
+                await run_scenario(client, build, counter, args.concurrency, 1)
+                results[name] = await run_scenario(
+                    client, build, counter, args.requests, args.concurrency
+                )
+                print(f"{name}: {results[name]}", file=sys.stderr)
+    return results
+
+
+def main() -> int:
+    args = parse_args()
+    configure_env(args)
+
+    started = time.perf_counter()
+    seed(args)
+    print(f"seeded in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+    results = asyncio.run(run(args))
+    output = {
+        "config": {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ("db_url", "output")
+        },
+        "database": os.environ["DB_URL"].split(":", 1)[0],
+        "results": results,
+    }
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+    print(text)
+    return 1 if any(result["errors"] for result in results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
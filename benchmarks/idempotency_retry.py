@@ -0,0 +1,165 @@
+"""
+Idempotency check: a request that fails or is cancelled midway, then
+retried with the same `Idempotency-Key`, must create every procedure once.
+
+- bulk: the second chunk of `/procedure/registry/bulk` raises, so the
+  first request gets a 500 and its retry creates the rows
+- cancel: the request to `/procedure/registry` is cancelled while its
+  endpoint thread is still running; the thread commits after the key was
+  released, and the retry creates the procedure
+
+Runs against a throwaway SQLite database by default:
+
+    python -m benchmarks.idempotency_retry
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "idempotency_retry.db")
+os.environ.setdefault("DB_URL", f"sqlite:///{DB_PATH}")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+os.environ.setdefault("ALGORITHM", "HS256")
+# two chunks of two rows
+os.environ["BULK_CHUNK_SIZE"] = "2"
+
+import httpx  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+from core.app import create_app  # noqa: E402
+from models.base import Base  # noqa: E402
+from models.doctor import Doctor  # noqa: E402
+from models.engine import get_engine, session_scope  # noqa: E402
+from models.patient import Patient  # noqa: E402
+from models.procedure import Procedure  # noqa: E402
+from models.user import User  # noqa: E402
+
+ROW = {
+    "doctor_id": 1,
+    "patient_id": 1,
+    "date": "2024-01-01",
+    "value": 10.5,
+    "payment_status": "paid",
+}
+
+
+def seed() -> None:
+    Base.metadata.create_all(bind=get_engine())
+    with session_scope() as session:
+        session.execute(
+            insert(User).values(id=1, username="admin", password="-", is_superuser=True)
+        )
+        session.execute(insert(Doctor).values(id=1, name="Doctor", user_id=1))
+        session.execute(insert(Patient).values(id=1, name="Patient"))
+        session.commit()
+
+
+def procedures() -> int:
+    with session_scope():
+        return Procedure.count()
+
+
+async def bulk(client: httpx.AsyncClient, headers: dict) -> list[str]:
+    bulk_create = Procedure.bulk_create
+    calls = 0
+
+    def failing_bulk_create(rows):
+        nonlocal calls
+        calls += 1
+        if calls == 2:
+            raise RuntimeError("second chunk failed")
+        return bulk_create(rows)
+
+    before = procedures()
+    Procedure.bulk_create = failing_bulk_create
+    try:
+        first = await client.post(
+            "/procedure/registry/bulk", json=[ROW] * 4, headers=headers
+        )
+    finally:
+        Procedure.bulk_create = bulk_create
+    retry = await client.post(
+        "/procedure/registry/bulk", json=[ROW] * 4, headers=headers
+    )
+    created = procedures() - before
+
+    print(
+        f"bulk: first {first.status_code}, retry {retry.status_code} "
+        f"(replayed {retry.headers.get('idempotent-replayed')}), {created} created"
+    )
+    errors = []
+    if first.status_code != 500 or retry.status_code != 200 or created != 4:
+        errors.append(f"bulk: expected a 500, a 200 and 4 created, got {created}")
+    return errors
+
+
+async def cancel(client: httpx.AsyncClient, headers: dict) -> list[str]:
+    create = Procedure.create
+    committing = []
+
+    def slow_create(self):
+        # still running in the threadpool after the request is cancelled
+        time.sleep(0.5)
+        try:
+            create(self)
+        except RuntimeError as error:
+            committing.append(str(error))
+            raise
+
+    before = procedures()
+    Procedure.create = slow_create
+    try:
+        first = asyncio.ensure_future(
+            client.post("/procedure/registry", json=ROW, headers=headers)
+        )
+        await asyncio.sleep(0.2)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        # let the endpoint thread try to commit
+        await asyncio.sleep(0.6)
+    finally:
+        Procedure.create = create
+    retry = await client.post("/procedure/registry", json=ROW, headers=headers)
+    created = procedures() - before
+
+    print(
+        f"cancel: late commit {committing or 'succeeded'}, retry "
+        f"{retry.status_code}, {created} created"
+    )
+    errors = []
+    if retry.status_code != 200 or created != 1:
+        errors.append(f"cancel: expected a 200 and 1 created, got {created}")
+    return errors
+
+
+async def run() -> list[str]:
+    app = create_app()
+    token = User.create_access_token({"sub": "admin"})
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://benchmark"
+        ) as client:
+            errors = []
+            for name, check in (("bulk", bulk), ("cancel", cancel)):
+                headers = {
+                    "Authorization": f"Bearer {token}",
+                    "Idempotency-Key": name,
+                }
+                errors += await check(client, headers)
+            return errors
+
+
+def main() -> int:
+    seed()
+    errors = asyncio.run(run())
+    for error in errors:
+        print(f"FAIL: {error}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Report job check: the glossed and financial jobs must finish with every
+row, in the thread and in the process (spawned) executors.
+
+Spawned workers start from a fresh interpreter that only imports the job
+module, so missing model imports only show up there. Runs against a
+throwaway SQLite database by default:
+
+    python -m benchmarks.report_jobs
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+TEMP_DIR = tempfile.mkdtemp()
+# inherited by the spawned workers, which run this module again
+os.environ.setdefault(
+    "DB_URL", f"sqlite:///{os.path.join(TEMP_DIR, 'report_jobs.db')}"
+)
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+ROWS = 50
+TIMEOUT = 60
+
+
+def seed() -> None:
+    # imported here: the spawned workers must not get the models from
+    # this module
+    from datetime import date
+
+    from sqlalchemy import insert
+
+    from models.base import Base
+    from models.doctor import Doctor
+    from models.engine import get_engine, session_scope
+    from models.patient import Patient
+    from models.procedure import Procedure, ProcedureRollup
+    from models.user import User
+
+    Base.metadata.create_all(bind=get_engine())
+    with session_scope() as session:
+        session.execute(
+            insert(User).values(
+                id=1, username="admin", password="-", is_superuser=True
+            )
+        )
+        session.execute(insert(Doctor).values(id=1, name="Doctor", user_id=1))
+        session.execute(insert(Patient).values(id=1, name="Patient"))
+        session.commit()
+        Procedure.bulk_create(
+            [
+                {
+                    "doctor_id": 1,
+                    "patient_id": 1,
+                    "date": date(2024, 1, 1 + index % 28),
+                    "value": 100,
+                    "payment_status": "glossed",
+                }
+                for index in range(ROWS)
+            ]
+        )
+        ProcedureRollup.rebuild()
+
+
+def run(executor: str) -> list[str]:
+    from datetime import date
+
+    from models.report_jobs import ReportJobs
+
+    jobs = ReportJobs(os.path.join(TEMP_DIR, executor), executor=executor)
+    expected = {
+        "glossed": (
+            {"doctor_id": None, "start": date(2024, 1, 1), "end": date(2024, 12, 1)},
+            ROWS,
+        ),
+        # one row per month and status
+        "financial": (
+            {"doctor_id": 1, "start": None, "end": None, "period": "month"},
+            1,
+        ),
+    }
+    submitted = {
+        report: jobs.submit(report, params) for report, (params, _) in expected.items()
+    }
+
+    errors = []
+    deadline = time.monotonic() + TIMEOUT
+    for report, job_id in submitted.items():
+        status = jobs.status(job_id)
+        while status["status"] in ("pending", "running"):
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+            status = jobs.status(job_id)
+
+        rows = expected[report][1]
+        if status["status"] != "done" or status["rows"] != rows:
+            errors.append(
+                f"{executor} {report}: {status['status']} with "
+                f"{status['rows']} rows (expected {rows}): {status['error']}"
+            )
+        else:
+            print(f"{executor} {report}: done, {rows} rows")
+    jobs.shutdown()
+    return errors
+
+
+def main() -> int:
+    seed()
+    errors = [error for executor in ("thread", "process") for error in run(executor)]
+    for error in errors:
+        print(f"FAIL: {error}")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
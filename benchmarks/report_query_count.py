@@ -0,0 +1,131 @@
+"""
+Regression benchmark: the number of queries of the report endpoints must
+not grow with the number of returned rows.
+
+Runs against a throwaway SQLite database by default:
+
+    python -m benchmarks.report_query_count
+"""
+
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "report_query_count.db")
+os.environ.setdefault("DB_URL", f"sqlite:///{DB_PATH}")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import delete, event, insert  # noqa: E402
+
+from core.app import create_app  # noqa: E402
+from models.doctor import Doctor  # noqa: E402
+from models.base import Base  # noqa: E402
+from models.engine import get_engine, session_scope  # noqa: E402
+from models.patient import Patient  # noqa: E402
+from models.procedure import Procedure  # noqa: E402
+from models.report_cache import REPORT_CACHE  # noqa: E402
+from models.user import User  # noqa: E402
+from validators.existence import (  # noqa: E402
+    ExistenceChecker,
+    set_existence_checker,
+)
+
+ROW_COUNTS = (10, 1000)
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def seed(rows: int) -> None:
+    with session_scope() as session:
+        session.execute(delete(Procedure))
+        if not session.get(User, 1):
+            session.execute(
+                insert(User).values(
+                    id=1, username="admin", password="-", is_superuser=True
+                )
+            )
+            session.execute(insert(Doctor).values(id=1, name="Doctor", user_id=1))
+            session.execute(insert(Patient).values(id=1, name="Patient"))
+        session.execute(
+            insert(Procedure),
+            [
+                {
+                    "doctor_id": 1,
+                    "patient_id": 1,
+                    "date": date.today(),
+                    "value": 100,
+                    "payment_status": "glossed",
+                }
+                for _ in range(rows)
+            ],
+        )
+        session.commit()
+
+
+def measure(client: TestClient, counter: QueryCounter, rows: int) -> dict:
+    seed(rows)
+    headers = {
+        "Authorization": "Bearer "
+        + User.create_access_token(data={"sub": "admin"})
+    }
+    today = date.today()
+    requests = {
+        "daily": lambda: client.get(
+            "/procedure/report/daily", params={"doctor_id": 1}, headers=headers
+        ),
+        "glossed": lambda: client.post(
+            "/procedure/report/glossed",
+            json={
+                "start": (today - timedelta(days=1)).isoformat(),
+                "end": (today + timedelta(days=1)).isoformat(),
+            },
+            headers=headers,
+        ),
+    }
+
+    result = {}
+    for name, request in requests.items():
+        # warm up the principal cache
+        request()
+        # measure the queries of the report itself, not a cached response
+        REPORT_CACHE.clear()
+        counter.count = 0
+        response = request()
+        response.raise_for_status()
+        assert len(response.json()) == rows, f"{name} did not return every row"
+        result[name] = {"rows": rows, "queries": counter.count}
+    return result
+
+
+def main() -> int:
+    # no cache, so any validator run while serializing the rows is counted
+    set_existence_checker(ExistenceChecker(ttl=0, negative_ttl=0))
+    client = TestClient(create_app())
+    Base.metadata.create_all(bind=get_engine())
+    counter = QueryCounter(get_engine())
+
+    results = {rows: measure(client, counter, rows) for rows in ROW_COUNTS}
+    for rows, result in results.items():
+        print(f"{rows} rows: {result}")
+
+    failed = False
+    for name in results[ROW_COUNTS[0]]:
+        counts = {results[rows][name]["queries"] for rows in ROW_COUNTS}
+        if len(counts) != 1:
+            print(f"FAIL: {name} query count depends on row count: {counts}")
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+"""
+Consistency check: the financial rollups must always equal the
+procedures grouped by doctor, payment status and day.
+
+Changes the procedures through every path that keeps the rollups (ORM
+create/update/delete, unit of work, bulk insert and status updates) and
+compares the rollups after each step, against a throwaway SQLite
+database by default:
+
+    python -m benchmarks.rollup_consistency
+"""
+
+import os
+import random
+import sys
+import tempfile
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "rollup_consistency.db")
+os.environ.setdefault("DB_URL", f"sqlite:///{DB_PATH}")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret-key")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+from sqlalchemy import insert, select  # noqa: E402
+
+from models.base import Base  # noqa: E402
+from models.doctor import Doctor  # noqa: E402
+from models.engine import get_engine, session_scope  # noqa: E402
+from models.patient import Patient  # noqa: E402
+from models.procedure import PAYMENT_STATUS, Procedure, ProcedureRollup  # noqa: E402
+from models.user import User  # noqa: E402
+
+DOCTORS = (1, 2, 3)
+START = date(2024, 1, 1)
+
+
+def random_row(rng: random.Random) -> dict:
+    return {
+        "doctor_id": rng.choice(DOCTORS),
+        "patient_id": 1,
+        "date": datetime.combine(
+            START + timedelta(days=rng.randrange(10)), datetime.min.time()
+        )
+        + timedelta(hours=rng.randrange(24)),
+        "value": Decimal(rng.randrange(1, 100000)) / 100,
+        "payment_status": rng.choice(PAYMENT_STATUS.enums),
+    }
+
+
+def seed() -> None:
+    with session_scope() as session:
+        session.execute(
+            insert(User).values(id=1, username="admin", password="-", is_superuser=True)
+        )
+        session.execute(
+            insert(Doctor), [{"id": id, "name": f"Doctor {id}"} for id in DOCTORS]
+        )
+        session.execute(insert(Patient).values(id=1, name="Patient"))
+        session.commit()
+
+
+def procedure_ids() -> list[int]:
+    statement = select(Procedure.id).order_by(Procedure.id)
+    return list(Procedure._database.scalars(statement))
+
+
+def orm_create(rng: random.Random) -> None:
+    for _ in range(20):
+        Procedure(**random_row(rng)).create()
+
+
+def orm_update(rng: random.Random) -> None:
+    # status, value, date and doctor changes, one or several at a time
+    for id in rng.sample(procedure_ids(), 10):
+        changes = random_row(rng)
+        keys = rng.sample(["doctor_id", "date", "value", "payment_status"], 2)
+        Procedure(**{key: changes[key] for key in keys}).update(id)
+
+
+def orm_delete(rng: random.Random) -> None:
+    for id in rng.sample(procedure_ids(), 5):
+        Procedure().delete(id)
+
+
+def unit_of_work(rng: random.Random) -> None:
+    deleted = rng.choice(procedure_ids())
+    with Procedure.unit_of_work():
+        for _ in range(5):
+            Procedure(**random_row(rng)).create()
+        Procedure().delete(deleted)
+
+
+def bulk_create(rng: random.Random) -> None:
+    Procedure.bulk_create([random_row(rng) for _ in range(200)])
+
+
+def update_status(rng: random.Random) -> None:
+    # every previous status, in several chunks
+    Procedure.update_status("paid", chunk_size=7, doctor_id=rng.choice(DOCTORS))
+    Procedure.update_status(
+        "glossed",
+        current_status="paid",
+        chunk_size=7,
+        id__in=rng.sample(procedure_ids(), 30),
+    )
+    Procedure.update_status("pending", date__lt=START + timedelta(days=3))
+
+
+STEPS = (
+    ("orm create", orm_create),
+    ("orm update", orm_update),
+    ("orm delete", orm_delete),
+    ("unit of work", unit_of_work),
+    ("bulk create", bulk_create),
+    ("update status", update_status),
+)
+
+
+def expected_rollups() -> dict:
+    totals = defaultdict(lambda: [Decimal(0), 0])
+    rows = Procedure._database.execute(
+        select(
+            Procedure.doctor_id,
+            Procedure.payment_status,
+            Procedure.date,
+            Procedure.value,
+        )
+    )
+    for doctor_id, payment_status, procedure_date, value in rows:
+        total = totals[(doctor_id, payment_status, procedure_date.date())]
+        total[0] += Decimal(str(value))
+        total[1] += 1
+    return {key: tuple(total) for key, total in totals.items()}
+
+
+def stored_rollups() -> dict:
+    rows = ProcedureRollup._database.execute(
+        select(
+            ProcedureRollup.doctor_id,
+            ProcedureRollup.payment_status,
+            ProcedureRollup.day,
+            ProcedureRollup.total_value,
+            ProcedureRollup.procedures,
+        )
+    )
+    # rows emptied by updates and deletes are kept with zero totals
+    return {
+        (doctor_id, payment_status, day): (Decimal(str(total)), procedures)
+        for doctor_id, payment_status, day, total, procedures in rows
+        if total or procedures
+    }
+
+
+def drift() -> list[str]:
+    expected, stored = expected_rollups(), stored_rollups()
+    return [
+        f"{key}: rollup {stored.get(key)}, procedures {expected.get(key)}"
+        for key in sorted(expected.keys() | stored.keys(), key=str)
+        if expected.get(key) != stored.get(key)
+    ]
+
+
+def main() -> int:
+    Base.metadata.create_all(bind=get_engine())
+    seed()
+    rng = random.Random(0)
+
+    failed = False
+    for name, step in STEPS:
+        with session_scope():
+            step(rng)
+        with session_scope():
+            errors = drift()
+            rollups = len(stored_rollups())
+        print(f"{name}: {rollups} rollups, {len(errors)} drifted")
+        for error in errors:
+            print(f"FAIL: {name}: {error}")
+        failed = failed or bool(errors)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Startup budget check: importing the app, creating it and running its
+startup must be fast and must not need a database.
+
+Each phase runs in a fresh interpreter, pointed to a database that does
+not exist, and the slowest imports are listed:
+
+    python -m benchmarks.startup --budget 1.0
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# runs in the child interpreter
+PROBE = """
+import asyncio, json, time
+started = time.perf_counter()
+from core.app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+
+async def startup():
+    async with app.router.lifespan_context(app):
+        return time.perf_counter()
+
+ready = asyncio.run(startup())
+print(json.dumps({
+    "import_seconds": imported - started,
+    "create_app_seconds": created - imported,
+    "lifespan_seconds": ready - created,
+    "total_seconds": ready - started,
+}))
+"""
+
+
+def child_env() -> dict:
+    env = dict(os.environ)
+    # nothing listens there: any connection attempt fails the check
+    env["DB_URL"] = "postgresql://benchmark@127.0.0.1:1/unreachable"
+    env.setdefault("SECRET_KEY", "benchmark-secret-key")
+    env.setdefault("ALGORITHM", "HS256")
+    env["DB_ASYNC"] = "false"
+    env["DB_CREATE_ALL"] = "false"
+    return env
+
+
+def measure() -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        env=child_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(count: int) -> list[tuple[str, float]]:
+    """
+    Get the top-level packages with the highest import time, including
+    their own imports (`-X importtime` cumulative time).
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import core.app"],
+        env=child_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    packages: dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        package = name.strip().split(".")[0]
+        seconds = int(cumulative) / 1_000_000
+        packages[package] = max(packages.get(package, 0), seconds)
+
+    # the app itself includes everything
+    packages.pop("core", None)
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget", type=float, default=1.0, help="Seconds")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports")
+    args = parser.parse_args()
+
+    # the best run, the others pay for cold disk caches
+    runs = [measure() for _ in range(args.runs)]
+    best = min(runs, key=lambda run: run["total_seconds"])
+    output = {
+        "budget_seconds": args.budget,
+        **{key: round(value, 4) for key, value in best.items()},
+        "slowest_imports": [
+            {"module": name, "seconds": round(seconds, 4)}
+            for name, seconds in slowest_imports(args.top)
+        ],
+    }
+    print(json.dumps(output, indent=2))
+
+    if best["total_seconds"] > args.budget:
+        print(
+            f"FAIL: startup took {best['total_seconds']:.3f}s, "
+            f"over the {args.budget}s budget"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,16 +2,23 @@ from fastapi import FastAPI
 
 from .config import (
     configure_cors,
-    configure_db,
+    configure_db_session,
+    configure_idempotency,
+    configure_metrics,
     configure_routes,
+    lifespan,
 )
+from .responses import FastJSONResponse
 
 
 def create_app() -> FastAPI:
-    app = FastAPI()
+    app = FastAPI(default_response_class=FastJSONResponse, lifespan=lifespan)
+    # the last added middleware runs first
+    configure_idempotency(app)
     configure_cors(app)
+    configure_db_session(app)
+    configure_metrics(app)
     configure_routes(app)
-    configure_db()
     return app
 
 
@@ -1,11 +1,25 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import Engine
 
+from core.metrics import MetricsMiddleware, instrument_engine
 from models.base import Base
-from models.engine import ENGINE, get_db
+from models.engine import (
+    DBSessionMiddleware,
+    dispose_engines,
+    env_bool,
+    get_engine,
+    init_engines,
+)
+from models.idempotency import IdempotencyMiddleware
+from models.report_jobs import REPORT_JOBS
 from routers.auth import router as auth_router
 from routers.doctor import router as doctor_router
+from routers.metrics import router as metrics_router
 from routers.patient import router as patient_router
+from routers.procedure import IDEMPOTENT_PATHS
 from routers.procedure import router as procedure_router
 
 
@@ -20,13 +34,41 @@ def configure_cors(application: FastAPI) -> None:
     )
 
 
+def configure_idempotency(application: FastAPI) -> None:
+    # innermost: replays still go through CORS and use the request session
+    application.add_middleware(IdempotencyMiddleware, paths=IDEMPOTENT_PATHS)
+
+
+def configure_db_session(application: FastAPI) -> None:
+    application.add_middleware(DBSessionMiddleware)
+
+
+def configure_metrics(application: FastAPI) -> None:
+    application.add_middleware(MetricsMiddleware)
+    # every engine, as they are only created on startup
+    instrument_engine(Engine)
+
+
 def configure_routes(application: FastAPI) -> None:
     application.include_router(procedure_router)
     application.include_router(patient_router)
     application.include_router(doctor_router)
     application.include_router(auth_router)
+    application.include_router(metrics_router)
+
 
+@asynccontextmanager
+async def lifespan(application: FastAPI):
+    """
+    Create the engines on startup and close their connections on shutdown,
+    after stopping the report job workers.
 
-def configure_db() -> None:
-    Base.metadata.bind = get_db()
-    Base.metadata.create_all(bind=ENGINE)
+    The schema is managed by Alembic; DB_CREATE_ALL creates the missing
+    tables on startup, for local development only.
+    """
+    init_engines()
+    if env_bool("DB_CREATE_ALL", False):
+        Base.metadata.create_all(bind=get_engine())
+    yield
+    REPORT_JOBS.shutdown()
+    await dispose_engines()
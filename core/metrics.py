@@ -0,0 +1,330 @@
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+logger = logging.getLogger(__name__)
+
+# seconds; statements slower than this are logged
+SLOW_QUERY_SECONDS = float(os.getenv("DB_SLOW_QUERY_MS", 500)) / 1000
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels[label] for label in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels[label] for label in self.labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip((*self.buckets, "+Inf"), counts):
+                    cumulative += count
+                    labels = _labels((*self.labels, "le"), (*key, bound))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _labels(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class StatsCollector:
+    """
+    Metrics read on each render from the `stats()` of components keeping
+    their own counters (pools, caches).
+
+    `metrics` maps the keys of the stats to (name suffix, type, help).
+    With a `label`, each component added is a label value of the same
+    metrics.
+    """
+
+    def __init__(self, prefix: str, metrics: dict, label: str | None = None):
+        self.prefix = prefix
+        self.metrics = metrics
+        self.label = label
+        self._sources: list[tuple] = []
+
+    def add(self, stats, label_value: str | None = None) -> None:
+        self._sources.append((label_value, stats))
+
+    def render(self) -> list[str]:
+        values = [(label_value, stats()) for label_value, stats in self._sources]
+        lines = []
+        for key, (suffix, kind, help) in self.metrics.items():
+            name = f"{self.prefix}_{suffix}"
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for label_value, stats in values:
+                labels = _labels((self.label,), (label_value,)) if self.label else ""
+                lines.append(f"{name}{labels} {stats[key]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Get every metric in the Prometheus text format.
+        """
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _escape(value) -> str:
+    value = str(value).replace("\\", "\\\\")
+    return value.replace('"', '\\"').replace("\n", "\\n")
+
+
+REGISTRY = MetricsRegistry()
+HTTP_REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Latency of the HTTP requests.",
+        ("method", "route", "status"),
+    )
+)
+HTTP_REQUEST_QUERIES = REGISTRY.register(
+    Histogram(
+        "http_request_db_queries",
+        "SQL statements executed per HTTP request.",
+        ("method", "route"),
+        QUERY_COUNT_BUCKETS,
+    )
+)
+HTTP_REQUEST_DB_SECONDS = REGISTRY.register(
+    Histogram(
+        "http_request_db_duration_seconds",
+        "Time spent on SQL statements per HTTP request.",
+        ("method", "route"),
+    )
+)
+DB_POOL_CHECKOUT_SECONDS = REGISTRY.register(
+    Histogram(
+        "db_pool_checkout_wait_seconds",
+        "Time to get a connection from the pool, waiting or connecting.",
+    )
+)
+DB_SLOW_QUERIES = REGISTRY.register(
+    Counter("db_slow_queries_total", "SQL statements slower than DB_SLOW_QUERY_MS.")
+)
+# the `TTLCache.stats()` of the caches, labeled by cache
+CACHE_METRICS = REGISTRY.register(
+    StatsCollector(
+        "cache",
+        {
+            "hits": ("hits_total", "counter", "Lookups found in the cache."),
+            "misses": ("misses_total", "counter", "Lookups missing or expired."),
+            "hit_rate": ("hit_ratio", "gauge", "Hits over lookups since startup."),
+            "size": ("entries", "gauge", "Entries in the cache."),
+            "bytes": ("bytes", "gauge", "Size of the entries, when measured."),
+        },
+        label="cache",
+    )
+)
+
+
+class RequestStats:
+    """
+    Database usage of the current request.
+    """
+
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# the threadpool copies the context, so sync queries still find the stats
+_REQUEST_STATS: ContextVar[RequestStats | None] = ContextVar(
+    "request_stats", default=None
+)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|(?<![$\w])\d+(?:\.\d+)?\b")
+# placeholders of the sqlite, psycopg2 and asyncpg drivers
+_PLACEHOLDER = r"(?:\?|%\(\w+\)s|\$\d+)"
+_PLACEHOLDER_LISTS = re.compile(
+    rf"\(\s*{_PLACEHOLDER}(?:\s*,\s*{_PLACEHOLDER})+\s*\)"
+)
+
+
+def normalize_sql(statement: str) -> str:
+    """
+    Normalize a statement to group slow queries: literals become `?`, lists
+    of placeholders (e.g. an expanded `IN`) become `(...)` and the
+    whitespace is collapsed.
+    """
+    statement = _LITERALS.sub("?", statement)
+    statement = _PLACEHOLDER_LISTS.sub("(...)", statement)
+    return " ".join(statement.split())
+
+
+def instrument_engine(engine) -> None:
+    """
+    Count the statements and DB time of the current request and log the
+    slow queries of an engine (the `sync_engine` of an async one), or of
+    every engine when given the `Engine` class.
+    """
+    listeners = {
+        "before_cursor_execute": _before_cursor_execute,
+        "after_cursor_execute": _after_cursor_execute,
+        "handle_error": _handle_error,
+    }
+    for name, listener in listeners.items():
+        # apps created more than once share the engine
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    elapsed = time.perf_counter() - conn.info["query_started_at"].pop()
+
+    stats = _REQUEST_STATS.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+
+    if elapsed >= SLOW_QUERY_SECONDS:
+        DB_SLOW_QUERIES.inc()
+        logger.warning(
+            "Slow query (%.1f ms): %s", elapsed * 1000, normalize_sql(statement)
+        )
+
+
+def _handle_error(context) -> None:
+    # the failed statement never reaches after_cursor_execute
+    if context.connection is not None:
+        started = context.connection.info.get("query_started_at")
+        if started:
+            started.pop()
+
+
+class _TimedCheckout:
+    """
+    Pool mixin recording how long each checkout waited for a connection.
+    """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.observe(time.perf_counter() - started)
+
+
+class TimedQueuePool(_TimedCheckout, QueuePool):
+    pass
+
+
+class TimedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording the latency, statements and DB time of
+    every HTTP request, labeled by the route template.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = _REQUEST_STATS.set(stats)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            _REQUEST_STATS.reset(token)
+
+            # the router sets the matched route on the scope
+            route = scope.get("route")
+            labels = {
+                "method": scope["method"],
+                "route": route.path if route is not None else "<unmatched>",
+            }
+            HTTP_REQUEST_SECONDS.observe(elapsed, status=status, **labels)
+            HTTP_REQUEST_QUERIES.observe(stats.queries, **labels)
+            HTTP_REQUEST_DB_SECONDS.observe(stats.db_seconds, **labels)
@@ -0,0 +1,54 @@
+from decimal import Decimal
+
+import orjson
+from fastapi.responses import JSONResponse
+
+
+def _default(value):
+    # Numeric columns are exposed as numbers by the API
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content) -> bytes:
+    """
+    Serialize to JSON with orjson. Dates, datetimes, enums and UUIDs are
+    handled natively and Decimal is written as a number.
+    """
+    return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Default response class of the app, rendered with orjson.
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def row_dicts(rows, converters: dict | None = None):
+    """
+    Yield Core result rows as dicts, ready to be serialized.
+
+    @Params:
+        - rows: Core rows (e.g. `Base.fetch` result)
+        - converters: Functions applied to the values of some columns, to
+            match the fields of the response model
+    """
+    converters = converters or {}
+    for row in rows:
+        values = row._asdict()
+        for key, convert in converters.items():
+            if values[key] is not None:
+                values[key] = convert(values[key])
+        yield values
+
+
+def dump_rows(rows, converters: dict | None = None) -> bytes:
+    """
+    Serialize Core result rows to a JSON list, without building a model
+    per row.
+    """
+    return dumps(list(row_dicts(rows, converters)))
@@ -0,0 +1,103 @@
+"""
+Management commands.
+
+    python manage.py rebuild-rollups
+    python manage.py create-partitions --months 3
+    python manage.py export-procedures procedures.parquet --start 2024-01-01
+    python manage.py purge-idempotency-keys
+"""
+
+import argparse
+import time
+from datetime import date
+
+from models.doctor import Doctor  # noqa: F401
+from models.engine import session_scope
+from models.idempotency import IdempotencyKey
+from models.patient import Patient  # noqa: F401
+from models.procedure import Procedure, ProcedureRollup
+from models.user import User  # noqa: F401
+
+
+def rebuild_rollups(args: argparse.Namespace) -> None:
+    """
+    Recompute the financial rollups from the procedures table.
+    """
+    with session_scope():
+        rows = ProcedureRollup.rebuild()
+    print(f"Rebuilt {rows} rollup rows.")
+
+
+def create_partitions(args: argparse.Namespace) -> None:
+    """
+    Create the monthly partitions of procedures ahead of time (postgres).
+    """
+    with session_scope():
+        created = Procedure.create_partitions(months=args.months)
+    print(f"Created {len(created)} partitions: {', '.join(created) or '-'}")
+
+
+def export_procedures(args: argparse.Namespace) -> None:
+    """
+    Export the procedures to a Parquet or Arrow IPC file.
+    """
+    # pyarrow is only imported by this command
+    from models.procedure_export import export_filters, write_export
+
+    format = args.format or (
+        "arrow" if args.output.endswith((".arrow", ".arrows")) else "parquet"
+    )
+    filters = export_filters(args.doctor_id, args.status, args.start, args.end)
+
+    started = time.perf_counter()
+    with session_scope(), open(args.output, "wb") as file:
+        rows = write_export(file, format, args.batch_size, replica=True, **filters)
+    elapsed = time.perf_counter() - started
+    print(f"Exported {rows} procedures to {args.output} in {elapsed:.1f}s.")
+
+
+def purge_idempotency_keys(args: argparse.Namespace) -> None:
+    """
+    Delete the expired idempotency keys (older than IDEMPOTENCY_TTL).
+    """
+    with session_scope():
+        deleted = IdempotencyKey.purge()
+    print(f"Deleted {deleted} expired idempotency keys.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rebuild = commands.add_parser("rebuild-rollups", help=rebuild_rollups.__doc__)
+    rebuild.set_defaults(func=rebuild_rollups)
+
+    partitions = commands.add_parser(
+        "create-partitions", help=create_partitions.__doc__
+    )
+    partitions.add_argument(
+        "--months", type=int, default=3, help="Months ahead of the current one"
+    )
+    partitions.set_defaults(func=create_partitions)
+
+    export = commands.add_parser("export-procedures", help=export_procedures.__doc__)
+    export.add_argument("output", help="File to write (.parquet or .arrow)")
+    export.add_argument("--format", choices=("arrow", "parquet"))
+    export.add_argument("--doctor-id", type=int)
+    export.add_argument("--status", choices=("paid", "pending", "glossed"))
+    export.add_argument("--start", type=date.fromisoformat, help="YYYY-MM-DD")
+    export.add_argument("--end", type=date.fromisoformat, help="YYYY-MM-DD")
+    export.add_argument("--batch-size", type=int, default=16384)
+    export.set_defaults(func=export_procedures)
+
+    purge = commands.add_parser(
+        "purge-idempotency-keys", help=purge_idempotency_keys.__doc__
+    )
+    purge.set_defaults(func=purge_idempotency_keys)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
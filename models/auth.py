@@ -1,7 +1,11 @@
 from __future__ import annotations
 
+import asyncio
 import os
+import threading
+import time
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Annotated
 
@@ -12,6 +16,12 @@ from fastapi.exceptions import HTTPException
 from fastapi.security import OAuth2PasswordBearer
 from jwt.exceptions import InvalidTokenError
 from passlib.context import CryptContext
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from core.metrics import CACHE_METRICS, REGISTRY, StatsCollector
+
+from .cache import TTLCache
 
 PWD_CONTEXT = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = os.getenv("SECRET_KEY")
@@ -19,6 +29,155 @@ ALGORITHM = os.getenv("ALGORITHM")
 OAUTH2_SCHEME = OAuth2PasswordBearer(tokenUrl="auth/token")
 
 
+class PasswordHasherPool:
+    """
+    Bounded thread pool where bcrypt hashing and verification run.
+
+    bcrypt releases the GIL, so the threads use all the cores while the
+    event loop keeps serving the other requests.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int = 0):
+        self.max_workers = max_workers
+        # 0 means an unbounded queue
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="password-hasher"
+        )
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+    async def run(self, func, *args):
+        """
+        Run `func` in the pool and wait for its result.
+        """
+        with self._lock:
+            if self.max_queue and self.queued >= self.max_queue:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many authentication requests, try again later",
+                )
+            self.queued += 1
+        submitted = time.perf_counter()
+
+        def task():
+            with self._lock:
+                self.queued -= 1
+                self.active += 1
+                self.wait_seconds += time.perf_counter() - submitted
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, task)
+
+    def stats(self) -> dict:
+        """
+        Get the queueing metrics of the pool.
+        """
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "queued": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "wait_seconds": self.wait_seconds,
+            }
+
+
+PASSWORD_HASHER_POOL = PasswordHasherPool(
+    max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1)),
+    max_queue=int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 0)),
+)
+PASSWORD_HASHER_METRICS = REGISTRY.register(
+    StatsCollector(
+        "password_hasher",
+        {
+            "max_workers": ("workers", "gauge", "Threads of the bcrypt pool."),
+            "queued": ("queued", "gauge", "Hashes waiting for a thread."),
+            "active": ("active", "gauge", "Hashes running."),
+            "completed": ("completed_total", "counter", "Hashes finished."),
+            "rejected": (
+                "rejected_total",
+                "counter",
+                "Hashes rejected with a 503, over PASSWORD_HASH_MAX_QUEUE.",
+            ),
+            "wait_seconds": (
+                "wait_seconds_total",
+                "counter",
+                "Time the hashes waited in the queue.",
+            ),
+        },
+    )
+)
+PASSWORD_HASHER_METRICS.add(PASSWORD_HASHER_POOL.stats)
+
+# authenticated principals (user + linked doctor) by token subject. The
+# entries are invalidated when the user or its doctor changes; the TTL
+# bounds how stale the other workers can be
+PRINCIPAL_CACHE = TTLCache(
+    maxsize=int(os.getenv("PRINCIPAL_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("PRINCIPAL_CACHE_TTL", 60)),
+)
+CACHE_METRICS.add(PRINCIPAL_CACHE.stats, "principal")
+# usernames and user ids changed in the transaction, invalidated on COMMIT
+_PENDING_PRINCIPALS_KEY = "principal_cache_pending"
+
+
+def mark_principals_changed(session: Session, usernames=(), user_ids=()) -> None:
+    """
+    Register users whose principal changed in the session transaction.
+
+    @Params:
+        - usernames: Cache keys (token subjects) to drop
+        - user_ids: Users whose cached principal is dropped, whatever its key
+    """
+    pending = session.info.setdefault(_PENDING_PRINCIPALS_KEY, (set(), set()))
+    pending[0].update(usernames)
+    pending[1].update(user_ids)
+
+
+# after the COMMIT: invalidated before it, a request authenticated in
+# between would cache the old principal again
+@event.listens_for(Session, "after_commit")
+def _invalidate_principals_on_commit(session: Session) -> None:
+    usernames, user_ids = session.info.pop(_PENDING_PRINCIPALS_KEY, ((), ()))
+    for username in usernames:
+        PRINCIPAL_CACHE.invalidate(username)
+    if user_ids:
+        PRINCIPAL_CACHE.invalidate_where(lambda principal: principal.id in user_ids)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_principals_on_rollback(session: Session) -> None:
+    session.info.pop(_PENDING_PRINCIPALS_KEY, None)
+
+
+def token_subject(authorization: str | None) -> str | None:
+    """
+    Get the username of a valid `Authorization: Bearer <token>` header,
+    without querying the user.
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except InvalidTokenError:
+        return None
+    return payload.get("sub")
+
+
 class IAuth:
     """
     Interface for authentication and password hashing.
@@ -40,6 +199,15 @@ class IAuth:
             plain_password.encode("utf-8"), hashed_password.encode("utf-8")
         )
 
+    @staticmethod
+    async def averify_password(plain_password: str, hashed_password: str) -> bool:
+        """
+        Verify the password in the password hasher pool.
+        """
+        return await PASSWORD_HASHER_POOL.run(
+            IAuth.verify_password, plain_password, hashed_password
+        )
+
     @staticmethod
     def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
         """
@@ -56,6 +224,13 @@ class IAuth:
     def get_password_hash(password) -> str:
         return PWD_CONTEXT.hash(password)
 
+    @staticmethod
+    async def aget_password_hash(password) -> str:
+        """
+        Hash the password in the password hasher pool.
+        """
+        return await PASSWORD_HASHER_POOL.run(PWD_CONTEXT.hash, password)
+
     @staticmethod
     def get_expire_minutes():
         """
@@ -64,7 +239,7 @@ class IAuth:
         return int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 
     async def get_current_user(self, token: Annotated[str, Depends(OAUTH2_SCHEME)]):
-        from models.user import TokenData, UserDetail  # noqa: F401
+        from models.user import TokenData
 
         credentials_exception = HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -79,10 +254,13 @@ class IAuth:
             token_data = TokenData(username=username)
         except InvalidTokenError:
             raise credentials_exception
-        user = self.get_by_username(username=token_data.username)
-        if user is None:
-            raise credentials_exception
-        return user
+        principal = PRINCIPAL_CACHE.get(token_data.username)
+        if principal is None:
+            principal = await self.aget_principal(username=token_data.username)
+            if not principal:
+                raise credentials_exception
+            PRINCIPAL_CACHE.set(token_data.username, principal)
+        return principal
 
     @classmethod
     @abstractmethod
@@ -93,3 +271,23 @@ class IAuth:
         from models.user import UserDetail  # noqa: F401
 
         pass
+
+    @classmethod
+    @abstractmethod
+    async def aget_by_username(cls, username: str) -> UserDetail | None:
+        """
+        Async version of `get_by_username`.
+        """
+        from models.user import UserDetail  # noqa: F401
+
+        pass
+
+    @classmethod
+    @abstractmethod
+    async def aget_principal(cls, username: str) -> Principal | None:
+        """
+        Get the user and its linked doctor by username.
+        """
+        from models.user import Principal  # noqa: F401
+
+        pass
@@ -1,27 +1,85 @@
-from sqlalchemy import and_, exists
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import exists, func, select
 from sqlalchemy.orm import DeclarativeBase
 
-from .engine import get_db
+from .engine import (
+    DB_ASYNC,
+    get_async_read_session,
+    get_async_session,
+    get_read_session,
+    get_session,
+)
+
+
+class _CurrentSession:
+    """
+    Resolve `Base._database` to the session of the current request.
+    """
+
+    def __get__(self, instance, owner):
+        return get_session()
+
+
+_UNIT_OF_WORK_DEPTH = "unit_of_work_depth"
+
+
+def _range_clauses(column, value) -> list:
+    start, end = value
+    clauses = []
+    # open-ended when one of the sides is None
+    if start is not None:
+        clauses.append(column >= start)
+    if end is not None:
+        clauses.append(column <= end)
+    return clauses
+
+
+# filter lookups (`<column>__<lookup>=value`) and the clauses they build
+_LOOKUPS = {
+    "in": lambda column, value: [column.in_(value)],
+    "ne": lambda column, value: [column != value],
+    "gt": lambda column, value: [column > value],
+    "gte": lambda column, value: [column >= value],
+    "lt": lambda column, value: [column < value],
+    "lte": lambda column, value: [column <= value],
+    "isnull": lambda column, value: [
+        column.is_(None) if value else column.is_not(None)
+    ],
+    "range": _range_clauses,
+}
 
 
 class Base(DeclarativeBase):
-    _database = next(get_db())
+    _database = _CurrentSession()
+    # fetch server generated columns with INSERT/UPDATE ... RETURNING
+    __mapper_args__ = {"eager_defaults": True}
 
     def create(self):
         self._database.add(self)
         self.save()
 
-    def update(self, id: int) -> None:
-        instance = (
-            self._database.query(self.__class__).filter(self.__class__.id == id).first()
-        )
+    def update(self, id: int):
+        """
+        Update the record with the id with the columns set on this instance.
+
+        Goes through the ORM, so the mapper events of the model run.
+        """
+        instance = self._database.get(self.__class__, id)
+        if instance is None:
+            return None
+
+        for column in self.__table__.columns:
+            value = getattr(self, column.key)
+            if column.key != "id" and value is not None:
+                setattr(instance, column.key, value)
         self.save()
         return instance
 
     def delete(self, id: int) -> bool:
-        instance = (
-            self._database.query(self.__class__).filter(self.__class__.id == id).first()
-        )
+        instance = self._database.get(self.__class__, id)
         if instance:
             self._database.delete(instance)
             self.save()
@@ -29,56 +87,288 @@ class Base(DeclarativeBase):
         return False
 
     def get(self, id: int):
-        return self._database.query(self.__class__).get(id)
+        return self._database.get(self.__class__, id)
 
     @classmethod
-    def filter(cls, **kwargs):
-        # pass kwargs by reference
-        range_filters = cls.__create_range_filter(kwargs)
-        remaining_filters = [
-            getattr(cls, key) == value for key, value in kwargs.items()
-        ]
+    def select_where(cls, **kwargs):
+        """
+        Build a `select()` of the model from Django-style filters.
 
-        all_filters = range_filters + remaining_filters
+        @Params:
+            - <column>=value: Equality filter
+            - <column>__<lookup>=value: `in`, `ne`, `gt`, `gte`, `lt`, `lte`,
+                `isnull` or `range`. Ranges are open-ended on a None side
+            - order_by: Column name or list of names, "-" prefix to descend
+            - limit: Max number of records
 
-        return cls._database.query(cls).filter(and_(*all_filters))
+        Values are always bound parameters, so statements with the same
+        filters share the compiled SQL in the statement cache.
+        """
+        order_by = kwargs.pop("order_by", None)
+        limit = kwargs.pop("limit", None)
+
+        statement = select(cls).where(*cls._filter_clauses(kwargs))
+        if order_by:
+            statement = statement.order_by(*cls._order_by_clauses(order_by))
+        if limit is not None:
+            statement = statement.limit(limit)
+        return statement
+
+    @classmethod
+    def filter(cls, **kwargs):
+        """
+        Get the records matching the filters of `select_where`.
+        """
+        return cls._database.scalars(cls.select_where(**kwargs))
 
     @classmethod
     def exists(cls, **kwargs) -> bool:
         """
         Check if a record exists in the database.
         """
-        return cls._database.query(
-            exists().where(
-                *[getattr(cls, key) == value for key, value in kwargs.items()]
-            )
-        ).scalar()
+        return cls._database.scalar(
+            select(exists().where(*cls._filter_clauses(kwargs)))
+        )
+
+    @classmethod
+    def count(cls, replica: bool = False, **kwargs) -> int:
+        """
+        Count the records matching the filters of `select_where`.
+        """
+        session = get_read_session() if replica else cls._database
+        return session.scalar(
+            select(func.count())
+            .select_from(cls)
+            .where(*cls._filter_clauses(kwargs))
+        )
+
+    @classmethod
+    def existing_ids(cls, ids, replica: bool = False) -> set[int]:
+        """
+        Get which of the given ids exist in the database, in a single query.
+
+        @Params:
+            - ids: Ids to check
+            - replica: Read from the read replica, when configured
+        """
+        ids = set(ids)
+        if not ids:
+            return set()
+
+        session = get_read_session() if replica else cls._database
+        return set(session.scalars(select(cls.id).where(cls.id.in_(ids))))
+
+    @classmethod
+    def fetch(cls, statement, replica: bool = False) -> list:
+        """
+        Execute a statement and get all its rows.
+
+        @Params:
+            - statement: Statement to execute
+            - replica: Read from the read replica, when configured. The
+                primary is still used after a write in the same session
+        """
+        session = get_read_session() if replica else cls._database
+        return session.execute(statement).all()
 
     def save(self):
-        self._database.commit()
-        self._database.refresh(self)
+        self.commit()
 
     @classmethod
-    def __create_range_filter(cls, kwargs: dict) -> list:
-        range_filters = []
+    def commit(cls):
+        """
+        Commit the session, except inside a unit of work, where the block
+        commits once at the end. Every write helper commits through here.
+        """
+        if cls._database.info.get(_UNIT_OF_WORK_DEPTH):
+            return
+        try:
+            cls._database.commit()
+        except Exception:
+            # a commit refused before its flush keeps the transaction open
+            cls._database.rollback()
+            raise
+
+    @classmethod
+    @contextmanager
+    def unit_of_work(cls):
+        """
+        Group the writes of the block in a single transaction.
 
-        for key in list(kwargs.keys()):
-            # check if is a range filter. Get the columns and create the filter
-            if key.endswith("__range"):
-                col_name = key[: -len("__range")]
-                column = getattr(cls, col_name, None)
-                start, end = kwargs.pop(key)
+        The write helpers inside the block (`create`, `delete`, and the
+        ones of the models, like `Procedure.bulk_create`) do not commit;
+        the writes are committed once when the block exits, or rolled back
+        if it raises. Call `session.flush()` inside the block when a
+        generated id is needed before the end.
+        """
+        session = cls._database
+        depth = session.info.get(_UNIT_OF_WORK_DEPTH, 0)
+        session.info[_UNIT_OF_WORK_DEPTH] = depth + 1
+        try:
+            yield session
+            if not depth:
+                session.commit()
+        except Exception:
+            if not depth:
+                session.rollback()
+            raise
+        finally:
+            session.info[_UNIT_OF_WORK_DEPTH] = depth
 
-                # if column does not exist, raise an error
-                if column is None:
-                    raise ValueError(
-                        f"Column {col_name} does not exist in {cls.__class__}"
-                    )
+    # async counterparts. With DB_ASYNC disabled they run the sync version
+    # in the threadpool, so the event loop is never blocked by a query
+
+    async def acreate(self):
+        if not DB_ASYNC:
+            return await run_in_threadpool(self.create)
+
+        session = get_async_session()
+        session.add(self)
+        await self.asave()
+
+    async def adelete(self, id: int) -> bool:
+        if not DB_ASYNC:
+            return await run_in_threadpool(self.delete, id)
+
+        session = get_async_session()
+        instance = await session.get(self.__class__, id)
+        if instance:
+            await session.delete(instance)
+            await session.commit()
+            return True
+        return False
+
+    async def aget(self, id: int):
+        if not DB_ASYNC:
+            return await run_in_threadpool(self.get, id)
+
+        return await get_async_session().get(self.__class__, id)
+
+    @classmethod
+    async def afilter(cls, **kwargs) -> list:
+        """
+        Get all the records matching the filters.
+        """
+        if not DB_ASYNC:
+            return await run_in_threadpool(lambda: cls.filter(**kwargs).all())
+
+        result = await get_async_session().scalars(cls.select_where(**kwargs))
+        return result.all()
+
+    @classmethod
+    async def afirst(cls, **kwargs):
+        """
+        Get the first record matching the filters.
+        """
+        if not DB_ASYNC:
+            return await run_in_threadpool(lambda: cls.filter(**kwargs).first())
+
+        kwargs["limit"] = 1
+        result = await get_async_session().scalars(cls.select_where(**kwargs))
+        return result.first()
+
+    @classmethod
+    async def aexists(cls, **kwargs) -> bool:
+        """
+        Check if a record exists in the database.
+        """
+        if not DB_ASYNC:
+            return await run_in_threadpool(cls.exists, **kwargs)
+
+        return await get_async_session().scalar(
+            select(exists().where(*cls._filter_clauses(kwargs)))
+        )
+
+    @classmethod
+    async def afetch(cls, statement, replica: bool = False) -> list:
+        """
+        Async version of `fetch`.
+        """
+        if not DB_ASYNC:
+            return await run_in_threadpool(cls.fetch, statement, replica)
+
+        session = get_async_read_session() if replica else get_async_session()
+        result = await session.execute(statement)
+        return result.all()
+
+    async def asave(self):
+        session = get_async_session()
+        if session.info.get(_UNIT_OF_WORK_DEPTH):
+            return
+        await session.commit()
+
+    @classmethod
+    @asynccontextmanager
+    async def aunit_of_work(cls):
+        """
+        Async version of `unit_of_work`.
+
+        With DB_ASYNC, the block also holds the sync session, where the
+        helpers without an async version (e.g. `Procedure.bulk_create`)
+        run in the threadpool. The sync session commits first, so the
+        async one can flush its pending objects on SQLite.
+        """
+        # the a* helpers run the sync session in the threadpool
+        session = cls._database
+        sessions = [
+            (
+                session,
+                partial(run_in_threadpool, session.commit),
+                partial(run_in_threadpool, session.rollback),
+            )
+        ]
+        if DB_ASYNC:
+            session = get_async_session()
+            sessions.append((session, session.commit, session.rollback))
+
+        depths = [held.info.get(_UNIT_OF_WORK_DEPTH, 0) for held, _, _ in sessions]
+        for (held, _, _), depth in zip(sessions, depths):
+            held.info[_UNIT_OF_WORK_DEPTH] = depth + 1
+        try:
+            yield session
+            for (_, commit, _), depth in zip(sessions, depths):
+                if not depth:
+                    await commit()
+        except Exception:
+            for (_, _, rollback), depth in zip(sessions, depths):
+                if not depth:
+                    await rollback()
+            raise
+        finally:
+            for (held, _, _), depth in zip(sessions, depths):
+                held.info[_UNIT_OF_WORK_DEPTH] = depth
+
+    @classmethod
+    def _filter_clauses(cls, kwargs: dict) -> list:
+        clauses = []
+        for key, value in kwargs.items():
+            col_name, _, lookup = key.rpartition("__")
+            if lookup not in _LOOKUPS:
+                col_name, lookup = key, None
+
+            column = cls._column(col_name)
+            if lookup is None:
+                clauses.append(column == value)
+            else:
+                clauses += _LOOKUPS[lookup](column, value)
+        return clauses
+
+    @classmethod
+    def _order_by_clauses(cls, order_by: str | list[str]) -> list:
+        if isinstance(order_by, str):
+            order_by = [order_by]
+
+        return [
+            cls._column(name[1:]).desc() if name.startswith("-") else cls._column(name)
+            for name in order_by
+        ]
+
+    @classmethod
+    def _column(cls, col_name: str):
+        column = cls.__table__.columns.get(col_name)
 
-                if not start or not end:
-                    raise ValueError(
-                        "Start and end values are required for range filter"
-                    )
+        # if column does not exist, raise an error
+        if column is None:
+            raise ValueError(f"Column {col_name} does not exist in {cls.__name__}")
 
-                range_filters.append(column.between(start, end))
-        return range_filters
+        return getattr(cls, col_name)
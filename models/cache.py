@@ -0,0 +1,103 @@
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire after `ttl` seconds.
+
+    Keeps hit/miss counters so the cache efficiency can be monitored.
+    When `maxbytes` is set, `sizeof` measures the values and the least
+    recently used entries are evicted to keep the total under it.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 60,
+        maxbytes: int = 0,
+        sizeof=None,
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof or (lambda value: 0)
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[0] < time.monotonic():
+                if entry is not _MISSING:
+                    self._pop(key)
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float | None = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        size = self._sizeof(value)
+        # never cache a value that alone does not fit
+        if self.maxbytes and size > self.maxbytes:
+            return
+
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (expires_at, value, size)
+            self.bytes += size
+            while len(self._data) > self.maxsize or (
+                self.maxbytes and self.bytes > self.maxbytes
+            ):
+                self._pop(next(iter(self._data)))
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._pop(key)
+
+    def invalidate_where(self, predicate) -> None:
+        """
+        Drop every entry whose value matches `predicate`.
+        """
+        with self._lock:
+            for key in [k for k, entry in self._data.items() if predicate(entry[1])]:
+                self._pop(key)
+
+    def invalidate_keys(self, predicate) -> None:
+        """
+        Drop every entry whose key matches `predicate`.
+        """
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self._pop(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _pop(self, key) -> None:
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
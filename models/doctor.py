@@ -1,22 +1,29 @@
 import typing
 
 from pydantic import AfterValidator, BaseModel, ConfigDict
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Integer, String, event, inspect
+from sqlalchemy.orm import object_session, relationship
 
-from validators.validators import user_exists
+from validators.validators import positive_id
 
+from .auth import mark_principals_changed
 from .base import Base
 
 
 class NewDoctor(BaseModel):
     name: str
-    user_id: typing.Annotated[int, AfterValidator(user_exists)]
+    user_id: typing.Annotated[int, AfterValidator(positive_id("User"))]
 
 
-class DoctorDetail(NewDoctor):
+class DoctorDetail(BaseModel):
+    """
+    Read model of a doctor, without the database validators of `NewDoctor`.
+    """
+
     model_config = ConfigDict(from_attributes=True)
 
+    name: str
+    user_id: int | None
     id: int
 
 
@@ -25,7 +32,7 @@ class Doctor(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id"))
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
 
     procedures = relationship("Procedure", back_populates="doctor")
     user = relationship("User", back_populates="doctor")
@@ -36,3 +43,19 @@ class Doctor(Base):
         Get doctor by user ID.
         """
         return cls.filter(user_id=user_id).first()
+
+    @classmethod
+    async def aget_by_user_id(cls, user_id: int) -> DoctorDetail | None:
+        """
+        Async version of `get_by_user_id`.
+        """
+        return await cls.afirst(user_id=user_id)
+
+
+@event.listens_for(Doctor, "after_insert")
+@event.listens_for(Doctor, "after_update")
+@event.listens_for(Doctor, "after_delete")
+def _invalidate_principal(mapper, connection, target: Doctor) -> None:
+    # the doctor may have been moved from another user
+    user_ids = {target.user_id, *inspect(target).attrs.user_id.history.deleted}
+    mark_principals_changed(object_session(target), user_ids=user_ids)
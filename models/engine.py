@@ -1,20 +1,330 @@
 import os
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Engine, create_engine, event
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine,
+    AsyncSession,
+    async_sessionmaker,
+    create_async_engine,
+)
+from sqlalchemy.orm import Session, sessionmaker
+
+from core.metrics import TimedAsyncQueuePool, TimedQueuePool
 
 load_dotenv()
 
-SQLALCHEMY_DATABASE_URL = os.getenv("DB_URL")
 
-ENGINE = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=ENGINE)
+def env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def pool_options(url: str, asynchronous: bool = False) -> dict:
+    """
+    Get the connection pool options from the environment.
+
+    Size them against the postgres `max_connections`: every worker
+    may open up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections.
+    """
+    # sqlite (local tests) uses its own pool classes without sizing options
+    if url.startswith("sqlite"):
+        return {}
+
+    return {
+        # records the checkout wait on the /metrics endpoint
+        "poolclass": TimedAsyncQueuePool if asynchronous else TimedQueuePool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_pre_ping": env_bool("DB_POOL_PRE_PING", True),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", 1800)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+    }
+
+
+def async_database_url(url: str) -> str:
+    """
+    Get the async driver version of a database url.
+    """
+    scheme, _, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    driver = {"postgresql": "asyncpg", "sqlite": "aiosqlite"}.get(dialect)
+    if driver is None:
+        raise ValueError(f"No async driver configured for {dialect}")
+    return f"{dialect}+{driver}://{rest}"
+
+
+# use AsyncSession (asyncpg) on the async helpers of the models
+DB_ASYNC = env_bool("DB_ASYNC", False)
+
+# engines and session factories by name ("primary", "replica" and their
+# "async_" versions), created on first use (or on app startup) so
+# importing the models never needs a database
+_ENGINES: dict[str, tuple] = {}
+_ENGINE_LOCK = threading.Lock()
+
+# marks the sessions that wrote, so their reads stay on the primary
+_WROTE = "wrote"
+
+
+def database_url() -> str:
+    url = os.getenv("DB_URL")
+    if not url:
+        raise RuntimeError("DB_URL is not configured.")
+    return url
+
+
+def replica_url() -> str | None:
+    """
+    Url of the read-only replica used by the reports, if any.
+    """
+    return os.getenv("DB_REPLICA_URL") or None
+
+
+def _engine_entry(name: str) -> tuple:
+    entry = _ENGINES.get(name)
+    if entry is None:
+        with _ENGINE_LOCK:
+            entry = _ENGINES.get(name)
+            if entry is None:
+                entry = _ENGINES[name] = _create_engine(name)
+    return entry
+
+
+def _create_engine(name: str) -> tuple:
+    url = replica_url() if name.endswith("replica") else database_url()
+    if name.startswith("async_"):
+        engine = create_async_engine(
+            async_database_url(url), **pool_options(url, asynchronous=True)
+        )
+        return engine, async_sessionmaker(
+            autoflush=False, expire_on_commit=False, bind=engine
+        )
+
+    engine = create_engine(url, **pool_options(url))
+    # objects keep their state after commit: sessions live for one
+    # request, and reloading every attribute would cost a SELECT per
+    # saved object
+    return engine, sessionmaker(
+        autocommit=False, autoflush=False, expire_on_commit=False, bind=engine
+    )
+
+
+def get_engine() -> Engine:
+    """
+    Get the engine of the app, created on the first call.
+
+    Creating it does not connect: connections are opened by the pool when
+    the first query runs.
+    """
+    return _engine_entry("primary")[0]
+
+
+def get_async_engine() -> AsyncEngine:
+    """
+    Async version of `get_engine`, used when DB_ASYNC is enabled.
+    """
+    return _engine_entry("async_primary")[0]
+
+
+def get_replica_engine() -> Engine:
+    """
+    Get the engine of the read replica, or the primary one when
+    DB_REPLICA_URL is not set.
+    """
+    return _engine_entry("replica" if replica_url() else "primary")[0]
+
+
+def init_engines() -> None:
+    """
+    Create the engines of the app, called on startup.
+    """
+    names = ["primary", "replica"] if replica_url() else ["primary"]
+    for name in names:
+        _engine_entry(name)
+        if DB_ASYNC:
+            _engine_entry(f"async_{name}")
+
+
+async def dispose_engines() -> None:
+    """
+    Close the pooled connections and drop the engines, called on shutdown.
+    """
+    with _ENGINE_LOCK:
+        entries = list(_ENGINES.values())
+        _ENGINES.clear()
+
+    for engine, _ in entries:
+        if isinstance(engine, AsyncEngine):
+            await engine.dispose()
+        else:
+            engine.dispose()
+
+
+def _new_session(name: str = "primary") -> Session:
+    return _engine_entry(name)[1]()
+
+
+def _new_async_session(name: str = "async_primary") -> AsyncSession:
+    return _engine_entry(name)[1]()
+
+
+@event.listens_for(Session, "after_flush")
+def _mark_flush(session, flush_context) -> None:
+    session.info[_WROTE] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_dml(orm_execute_state) -> None:
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info[_WROTE] = True
+
+
+# sessions bound to the current request (or script) context
+_CURRENT_SESSION: ContextVar[Session | None] = ContextVar(
+    "current_session", default=None
+)
+_CURRENT_ASYNC_SESSION: ContextVar[AsyncSession | None] = ContextVar(
+    "current_async_session", default=None
+)
+_CURRENT_REPLICA_SESSION: ContextVar[Session | None] = ContextVar(
+    "current_replica_session", default=None
+)
+_CURRENT_ASYNC_REPLICA_SESSION: ContextVar[AsyncSession | None] = ContextVar(
+    "current_async_replica_session", default=None
+)
 
 
 def get_db():
-    db = SessionLocal()
+    db = _new_session()
     try:
         yield db
     finally:
         db.close()
+
+
+@contextmanager
+def session_scope():
+    """
+    Open a session bound to the current context and close it on exit.
+
+    Any uncommitted work is rolled back when the block raises. With a
+    replica configured, a replica session is bound too; it only connects
+    if a read is routed to it.
+    """
+    session = _new_session()
+    replica = _new_session("replica") if replica_url() else None
+    token = _CURRENT_SESSION.set(session)
+    replica_token = _CURRENT_REPLICA_SESSION.set(replica)
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        _CURRENT_REPLICA_SESSION.reset(replica_token)
+        _CURRENT_SESSION.reset(token)
+        session.close()
+        if replica is not None:
+            replica.close()
+
+
+def get_session() -> Session:
+    """
+    Get the session bound to the current context.
+    """
+    session = _CURRENT_SESSION.get()
+    if session is None:
+        raise RuntimeError(
+            "No database session bound to the current context. "
+            "Use `session_scope()` or the `DBSessionMiddleware`."
+        )
+    return session
+
+
+def get_read_session() -> Session:
+    """
+    Get the session for read-only queries: the replica one, unless no
+    replica is configured or the current session already wrote (so the
+    context reads its own writes).
+    """
+    session = get_session()
+    replica = _CURRENT_REPLICA_SESSION.get()
+    if replica is None or session.info.get(_WROTE):
+        return session
+    return replica
+
+
+@asynccontextmanager
+async def async_session_scope():
+    """
+    Async version of `session_scope`, used when DB_ASYNC is enabled.
+    """
+    replica = _new_async_session("async_replica") if replica_url() else None
+    async with _new_async_session() as session:
+        token = _CURRENT_ASYNC_SESSION.set(session)
+        replica_token = _CURRENT_ASYNC_REPLICA_SESSION.set(replica)
+        try:
+            yield session
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            _CURRENT_ASYNC_REPLICA_SESSION.reset(replica_token)
+            _CURRENT_ASYNC_SESSION.reset(token)
+            if replica is not None:
+                await replica.close()
+
+
+def get_async_session() -> AsyncSession:
+    """
+    Get the async session bound to the current context.
+    """
+    session = _CURRENT_ASYNC_SESSION.get()
+    if session is None:
+        raise RuntimeError(
+            "No async database session bound to the current context. "
+            "Use `async_session_scope()` or the `DBSessionMiddleware`."
+        )
+    return session
+
+
+def get_async_read_session() -> AsyncSession:
+    """
+    Async version of `get_read_session`.
+    """
+    session = get_async_session()
+    replica = _CURRENT_ASYNC_REPLICA_SESSION.get()
+    if replica is None or session.info.get(_WROTE):
+        return session
+    return replica
+
+
+class DBSessionMiddleware:
+    """
+    ASGI middleware that gives every request its own session.
+
+    The session only checks out a connection from the pool on its first
+    query, so requests that never touch the database cost nothing.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+
+        with session_scope():
+            if not DB_ASYNC:
+                await self.app(scope, receive, send)
+                return
+
+            async with async_session_scope():
+                await self.app(scope, receive, send)
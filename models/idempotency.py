@@ -0,0 +1,404 @@
+"""
+Idempotency keys of the POST endpoints that create records.
+
+A client sends `Idempotency-Key: <unique value>` and retries with the same
+key. The first request reserves the key in `idempotency_keys`, unique per
+user, endpoint and key, and its response is stored there. The retries get
+that response back without running the endpoint again: no validation and
+no INSERT. Stored responses never change, so they are also kept in memory
+and most replays do not query the database.
+
+The commits of the endpoint also mark the reservation as committed, in
+the same transaction, and fail when the reservation is gone. A request
+that fails before committing releases its key, so it can be retried; one
+that fails after it keeps the key, with its response when there is one.
+A worker dying before committing leaves the key in progress, so the
+reservations have a lease: after `IDEMPOTENCY_LEASE` seconds without a
+commit, the key can be reserved again, and the late commit of the first
+request fails.
+"""
+
+import hashlib
+import os
+import typing
+from datetime import datetime, timedelta, timezone
+
+import anyio
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Integer,
+    LargeBinary,
+    String,
+    UniqueConstraint,
+    and_,
+    delete,
+    event,
+    or_,
+    update,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .auth import token_subject
+from .base import Base
+from .cache import TTLCache
+from .engine import DB_ASYNC, get_async_session, get_session, session_scope
+
+IDEMPOTENCY_HEADER = b"idempotency-key"
+MAX_KEY_LENGTH = 255
+
+# seconds a key is kept after its first request
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", 86400))
+# seconds a key stays reserved by a request that did not commit
+IDEMPOTENCY_LEASE = float(os.getenv("IDEMPOTENCY_LEASE", 60))
+
+# id of the reservation held by the request of the session
+_RESERVATION_KEY = "idempotency_reservation"
+
+
+class StoredResponse(typing.NamedTuple):
+    # sha256 of the request body, None when the endpoint did not read it all
+    request_hash: str | None
+    status_code: int
+    content_type: str | None
+    body: bytes
+
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        UniqueConstraint(
+            "subject",
+            "endpoint",
+            "key",
+            name="uq_idempotency_keys_subject_endpoint_key",
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    # username of the token, so users never see each other's responses
+    subject = Column(String, nullable=False)
+    endpoint = Column(String, nullable=False)
+    key = Column(String(MAX_KEY_LENGTH), nullable=False)
+    request_hash = Column(String(64))
+    # null while the first request runs
+    status_code = Column(Integer)
+    content_type = Column(String)
+    body = Column(LargeBinary)
+    created_at = Column(DateTime, nullable=False, index=True)
+    # set in the transaction of the endpoint writes, see `_mark_committed`
+    committed_at = Column(DateTime)
+
+    @classmethod
+    def reserve(
+        cls,
+        subject: str,
+        endpoint: str,
+        key: str,
+        ttl: float = IDEMPOTENCY_TTL,
+        lease: float = IDEMPOTENCY_LEASE,
+    ) -> tuple[int | None, "IdempotencyKey | None"]:
+        """
+        Reserve a key for a new request, in its own transaction.
+
+        @Return:
+            The id of the reservation, or the row of the request holding the
+            key. A key expired `ttl` seconds after its first request, or
+            still not committed `lease` seconds after it, is released and
+            reserved again
+        """
+        session = cls._database
+        now = _utcnow()
+        released = or_(
+            cls.created_at <= now - timedelta(seconds=ttl),
+            and_(
+                cls.committed_at.is_(None),
+                cls.created_at <= now - timedelta(seconds=lease),
+            ),
+        )
+        row = None
+        for _ in range(2):
+            reservation = cls(subject=subject, endpoint=endpoint, key=key)
+            reservation.created_at = now
+            try:
+                reservation.create()
+                return reservation.id, None
+            except IntegrityError:
+                session.rollback()
+
+            row = cls.filter(subject=subject, endpoint=endpoint, key=key).first()
+            if row is None:
+                continue
+            # checked again on the DELETE, in case the request committed
+            if row.created_at > now - timedelta(seconds=ttl) and not (
+                row.committed_at is None
+                and row.created_at <= now - timedelta(seconds=lease)
+            ):
+                return None, row
+            deleted = session.execute(delete(cls).where(cls.id == row.id, released))
+            session.commit()
+            if not deleted.rowcount:
+                return None, row
+        # reserved again by a concurrent request
+        return None, row
+
+    @classmethod
+    def store(cls, id: int, response: StoredResponse) -> None:
+        """
+        Save the response of the request holding the reservation.
+        """
+        cls._database.execute(
+            update(cls).where(cls.id == id).values(**response._asdict())
+        )
+        cls._database.commit()
+
+    @classmethod
+    def release(cls, id: int) -> bool:
+        """
+        Delete a reservation, so the request can be retried with its key,
+        unless the request committed.
+
+        @Return:
+            If the reservation was deleted
+        """
+        result = cls._database.execute(
+            delete(cls).where(cls.id == id, cls.committed_at.is_(None))
+        )
+        cls._database.commit()
+        return bool(result.rowcount)
+
+    @classmethod
+    def purge(cls, ttl: float = IDEMPOTENCY_TTL) -> int:
+        """
+        Delete the expired keys, returning how many were deleted.
+        """
+        result = cls._database.execute(
+            delete(cls).where(cls.created_at <= _utcnow() - timedelta(seconds=ttl))
+        )
+        cls._database.commit()
+        return result.rowcount
+
+    def stored_response(self) -> StoredResponse:
+        return StoredResponse(
+            self.request_hash, self.status_code, self.content_type, self.body
+        )
+
+
+def _utcnow() -> datetime:
+    # the column has no time zone
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@event.listens_for(Session, "before_commit")
+def _mark_committed(session: Session) -> None:
+    # in the transaction of the endpoint: the reservation is kept whenever
+    # its writes are, and they are not when it was released or taken over
+    reservation = session.info.get(_RESERVATION_KEY)
+    if reservation is None:
+        return
+    marked = session.execute(
+        update(IdempotencyKey)
+        .where(IdempotencyKey.id == reservation)
+        .values(committed_at=_utcnow())
+    )
+    if not marked.rowcount:
+        raise RuntimeError("The Idempotency-Key of the request was released.")
+
+
+# responses of the keys used on this worker, by (subject, endpoint, key)
+IDEMPOTENCY_CACHE = TTLCache(
+    maxsize=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", 10000)),
+    ttl=IDEMPOTENCY_TTL,
+    maxbytes=int(os.getenv("IDEMPOTENCY_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    sizeof=lambda response: len(response.body),
+)
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware honoring the `Idempotency-Key` header on the POST
+    requests to `paths`.
+
+    Requests without the header, or without a valid token, run as usual.
+    A retry of a request still running gets a 409, until its lease ends. A
+    server error (5xx), an exception or a cancelled request releases the
+    key when the endpoint did not commit, so the request can be retried;
+    otherwise the 5xx is stored as the response. Replays answer with
+    the `Idempotent-Replayed: true` header, and a 422 when the key was used
+    with another body.
+
+    Must run inside the `DBSessionMiddleware`.
+    """
+
+    def __init__(
+        self,
+        app,
+        paths: typing.Iterable[str],
+        ttl: float = IDEMPOTENCY_TTL,
+        lease: float = IDEMPOTENCY_LEASE,
+    ):
+        self.app = app
+        self.paths = frozenset(paths)
+        self.ttl = ttl
+        self.lease = lease
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"] not in self.paths
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope["headers"])
+        key = headers.get(IDEMPOTENCY_HEADER)
+        # the endpoint answers the requests without a valid token
+        subject = token_subject(headers.get(b"authorization", b"").decode("latin-1"))
+        if key is None or subject is None:
+            await self.app(scope, receive, send)
+            return
+
+        key = key.decode("latin-1")
+        if not 0 < len(key) <= MAX_KEY_LENGTH:
+            await _message(scope, receive, send, 400, "Invalid Idempotency-Key.")
+            return
+
+        cache_key = (subject, scope["path"], key)
+        response = IDEMPOTENCY_CACHE.get(cache_key)
+        if response is None:
+            reservation, row = await run_in_threadpool(
+                IdempotencyKey.reserve,
+                subject,
+                scope["path"],
+                key,
+                self.ttl,
+                self.lease,
+            )
+            if reservation is not None:
+                await self._run(reservation, cache_key, scope, receive, send)
+                return
+            if row is None or row.status_code is None:
+                message = "A request with this Idempotency-Key is in progress."
+                if row is not None and row.committed_at is not None:
+                    message = (
+                        "A request with this Idempotency-Key saved its changes,"
+                        " but its response was lost."
+                    )
+                await _message(scope, receive, send, 409, message)
+                return
+
+            response = row.stored_response()
+            expires_in = (row.created_at - _utcnow()).total_seconds() + self.ttl
+            IDEMPOTENCY_CACHE.set(cache_key, response, ttl=expires_in)
+
+        await _replay(response, scope, receive, send)
+
+    async def _run(self, reservation: int, cache_key: tuple, scope, receive, send):
+        """
+        Run the endpoint, then store its response under the key.
+        """
+        digest = hashlib.sha256()
+        read_all = False
+        start = {}
+        chunks = []
+
+        async def hashing_receive():
+            nonlocal read_all
+            message = await receive()
+            if message["type"] == "http.request":
+                digest.update(message.get("body", b""))
+                read_all = not message.get("more_body", False)
+            return message
+
+        async def capturing_send(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+            await send(message)
+
+        # the commits of the endpoint mark the reservation, see
+        # `_mark_committed`
+        sessions = [get_session(), *([get_async_session()] if DB_ASYNC else [])]
+        for session in sessions:
+            session.info[_RESERVATION_KEY] = reservation
+
+        response = None
+        released = False
+        try:
+            await self.app(scope, hashing_receive, capturing_send)
+            # kept on a failure: a cancelled endpoint thread may still commit
+            for session in sessions:
+                session.info.pop(_RESERVATION_KEY, None)
+            if start:
+                content_type = dict(start.get("headers", ())).get(b"content-type")
+                response = StoredResponse(
+                    request_hash=digest.hexdigest() if read_all else None,
+                    status_code=start["status"],
+                    content_type=content_type and content_type.decode("latin-1"),
+                    body=b"".join(chunks),
+                )
+        finally:
+            if response is None or response.status_code >= 500:
+                # also when cancelled (client gone, shutdown)
+                with anyio.CancelScope(shield=True):
+                    released = await run_in_threadpool(_release, reservation)
+
+        # a 5xx after a commit is replayed too, so the retry does not save
+        # the changes again
+        if response is not None and not released:
+            await run_in_threadpool(IdempotencyKey.store, reservation, response)
+            IDEMPOTENCY_CACHE.set(cache_key, response, ttl=self.ttl)
+
+
+def _release(reservation: int) -> bool:
+    # in its own session: the one of the request may be in a failed
+    # transaction, or still used by a cancelled endpoint thread
+    with session_scope():
+        return IdempotencyKey.release(reservation)
+
+
+async def _replay(response: StoredResponse, scope, receive, send) -> None:
+    if response.request_hash is not None:
+        digest = hashlib.sha256()
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                return
+            digest.update(message.get("body", b""))
+            more_body = message.get("more_body", False)
+
+        if digest.hexdigest() != response.request_hash:
+            await _message(
+                scope,
+                receive,
+                send,
+                422,
+                "Idempotency-Key already used with another request body.",
+            )
+            return
+
+    headers = [
+        (b"content-length", str(len(response.body)).encode()),
+        (b"idempotent-replayed", b"true"),
+    ]
+    if response.content_type:
+        headers.append((b"content-type", response.content_type.encode("latin-1")))
+    await send(
+        {
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": headers,
+        }
+    )
+    await send({"type": "http.response.body", "body": response.body})
+
+
+async def _message(scope, receive, send, status_code: int, message: str) -> None:
+    response = JSONResponse(status_code=status_code, content={"message": message})
+    await response(scope, receive, send)
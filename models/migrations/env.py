@@ -6,6 +6,7 @@ from sqlalchemy import engine_from_config, pool
 
 from models.base import Base
 from models.doctor import Doctor  # noqa: F401
+from models.idempotency import IdempotencyKey  # noqa: F401
 from models.patient import Patient  # noqa: F401
 from models.procedure import Procedure  # noqa: F401
 from models.user import User  # noqa: F401
@@ -0,0 +1,36 @@
+"""Report indexes
+
+Revision ID: 9b1f3c7d2e4a
+Revises: 32e2c567b6fe
+Create Date: 2026-10-18 10:12:41.503218
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9b1f3c7d2e4a'
+down_revision: Union[str, None] = '32e2c567b6fe'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # built concurrently (outside the migration transaction) so the
+    # procedures table is not locked for writes on large databases
+    with op.get_context().autocommit_block():
+        op.create_index(op.f('ix_doctors_user_id'), 'doctors', ['user_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_procedures_doctor_id_date', 'procedures', ['doctor_id', 'date'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_procedures_payment_status_date', 'procedures', ['payment_status', 'date'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_procedures_doctor_id_payment_status', 'procedures', ['doctor_id', 'payment_status'], unique=False, postgresql_include=['value'], postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_procedures_doctor_id_payment_status', table_name='procedures')
+    op.drop_index('ix_procedures_payment_status_date', table_name='procedures')
+    op.drop_index('ix_procedures_doctor_id_date', table_name='procedures')
+    op.drop_index(op.f('ix_doctors_user_id'), table_name='doctors')
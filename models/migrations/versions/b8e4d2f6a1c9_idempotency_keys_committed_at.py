@@ -0,0 +1,28 @@
+"""Idempotency keys committed at
+
+Revision ID: b8e4d2f6a1c9
+Revises: f3a9c6e1b8d4
+Create Date: 2026-10-18 18:05:27.318402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8e4d2f6a1c9'
+down_revision: Union[str, None] = 'f3a9c6e1b8d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('idempotency_keys', sa.Column('committed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_column('idempotency_keys', 'committed_at')
@@ -0,0 +1,44 @@
+"""Procedure rollups
+
+Revision ID: c4d8e2a91f07
+Revises: 9b1f3c7d2e4a
+Create Date: 2026-10-18 11:02:17.884312
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c4d8e2a91f07'
+down_revision: Union[str, None] = '9b1f3c7d2e4a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('procedure_rollups',
+    sa.Column('doctor_id', sa.Integer(), nullable=False),
+    sa.Column('payment_status', postgresql.ENUM('paid', 'pending', 'glossed', name='payment_status', create_type=False), nullable=False),
+    sa.Column('day', sa.Date(), nullable=False),
+    sa.Column('total_value', sa.Numeric(precision=14, scale=2), nullable=False),
+    sa.Column('procedures', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['doctor_id'], ['doctors.id'], ),
+    sa.PrimaryKeyConstraint('doctor_id', 'payment_status', 'day')
+    )
+    # backfill from the existing procedures
+    op.execute(
+        "INSERT INTO procedure_rollups "
+        "(doctor_id, payment_status, day, total_value, procedures) "
+        "SELECT doctor_id, payment_status, date(date), sum(value), count(id) "
+        "FROM procedures GROUP BY doctor_id, payment_status, date(date)"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('procedure_rollups')
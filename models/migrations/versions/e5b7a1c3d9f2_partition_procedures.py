@@ -0,0 +1,116 @@
+"""Partition procedures by month
+
+Revision ID: e5b7a1c3d9f2
+Revises: c4d8e2a91f07
+Create Date: 2026-10-18 15:40:09.117264
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e5b7a1c3d9f2'
+down_revision: Union[str, None] = 'c4d8e2a91f07'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# months created ahead of the current one; afterwards kept by
+# `python manage.py create-partitions`
+MONTHS_AHEAD = 3
+
+INDEXES = (
+    ('ix_procedures_id', ['id'], {}),
+    ('ix_procedures_doctor_id_date', ['doctor_id', 'date'], {}),
+    ('ix_procedures_payment_status_date', ['payment_status', 'date'], {}),
+    ('ix_procedures_doctor_id_payment_status', ['doctor_id', 'payment_status'], {'postgresql_include': ['value']}),
+)
+
+COLUMNS = "id, doctor_id, patient_id, date, value, payment_status"
+
+
+def _rename_table(old: str, new: str) -> None:
+    # frees the names of the table, its indexes and foreign keys
+    op.execute(f"ALTER TABLE {old} RENAME TO {new}")
+    op.execute(f"ALTER INDEX {old}_pkey RENAME TO {new}_pkey")
+    for name, _, _ in INDEXES:
+        op.drop_index(name, table_name=new)
+    op.execute(
+        f"ALTER TABLE {new} "
+        f"DROP CONSTRAINT {old}_doctor_id_fkey, "
+        f"DROP CONSTRAINT {old}_patient_id_fkey"
+    )
+
+
+def _create_table(primary_key: str, partition_by: str = "") -> None:
+    op.execute(
+        "CREATE TABLE procedures ("
+        "id INTEGER NOT NULL DEFAULT nextval('procedures_id_seq'), "
+        "doctor_id INTEGER NOT NULL REFERENCES doctors (id), "
+        "patient_id INTEGER NOT NULL REFERENCES patients (id), "
+        "date TIMESTAMP WITHOUT TIME ZONE NOT NULL, "
+        "value NUMERIC(10, 2) NOT NULL, "
+        "payment_status payment_status NOT NULL, "
+        f"PRIMARY KEY ({primary_key})"
+        f") {partition_by}"
+    )
+
+
+def _move_rows(source: str) -> None:
+    op.execute(f"INSERT INTO procedures ({COLUMNS}) SELECT {COLUMNS} FROM {source}")
+    # the id sequence must survive the old table
+    op.execute("ALTER SEQUENCE procedures_id_seq OWNED BY procedures.id")
+    op.execute(f"DROP TABLE {source}")
+    for name, columns, options in INDEXES:
+        op.create_index(name, 'procedures', columns, unique=False, **options)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # declarative partitioning is postgres only, sqlite keeps the heap
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    # runs in the migration transaction: the table is locked while the
+    # rows are copied, so run it in a maintenance window on large databases
+    _rename_table('procedures', 'procedures_heap')
+    # the partition key must be part of the primary key
+    _create_table('id, date', 'PARTITION BY RANGE (date)')
+    # rows outside every monthly partition
+    op.execute("CREATE TABLE procedures_default PARTITION OF procedures DEFAULT")
+    op.execute(
+        f"""
+        DO $$
+        DECLARE
+            month date := date_trunc(
+                'month', coalesce((SELECT min(date) FROM procedures_heap), now())
+            )::date;
+            last_month date := (
+                date_trunc('month', now()) + interval '{MONTHS_AHEAD} months'
+            )::date;
+        BEGIN
+            WHILE month <= last_month LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF procedures FOR VALUES FROM (%L) TO (%L)',
+                    'procedures_y' || to_char(month, 'YYYY"m"MM'),
+                    month,
+                    (month + interval '1 month')::date
+                );
+                month := (month + interval '1 month')::date;
+            END LOOP;
+        END $$
+        """
+    )
+    _move_rows('procedures_heap')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    _rename_table('procedures', 'procedures_partitioned')
+    _create_table('id')
+    # dropping the partitioned table drops its partitions
+    _move_rows('procedures_partitioned')
@@ -1,13 +1,98 @@
+import base64
+import json
 import typing
-from datetime import date
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 
-from pydantic import AfterValidator, BaseModel, ConfigDict
-from sqlalchemy import Column, DateTime, Enum, ForeignKey, Integer, Numeric, func
-from sqlalchemy.orm import relationship
+from pydantic import AfterValidator, BaseModel, ConfigDict, model_validator
+from sqlalchemy import (
+    Column,
+    Date,
+    DateTime,
+    Enum,
+    ForeignKey,
+    Index,
+    Integer,
+    Numeric,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    select,
+    text,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session, object_session, relationship
+from sqlalchemy.sql.functions import FunctionElement
 
-from validators.validators import doctor_exists, patient_exists, value_is_number
+from validators.validators import positive_id, value_is_number
 
 from .base import Base
+from .engine import get_read_session
+from .report_cache import REPORT_CACHE
+
+
+PAYMENT_STATUS = Enum("paid", "pending", "glossed", name="payment_status")
+
+ReportPeriod = typing.Literal["day", "week", "month"]
+
+# set on the session info when a transaction updates or deletes procedures
+ROWS_REMOVED_KEY = "procedures_removed"
+
+
+class week_start(FunctionElement):
+    """
+    Monday of the week of a date.
+    """
+
+    type = Date()
+    inherit_cache = True
+
+
+class month_start(FunctionElement):
+    """
+    First day of the month of a date.
+    """
+
+    type = Date()
+    inherit_cache = True
+
+
+@compiles(week_start)
+def _week_start(element, compiler, **kw):
+    day = compiler.process(element.clauses, **kw)
+    return f"date({day}, '-6 days', 'weekday 1')"
+
+
+@compiles(week_start, "postgresql")
+def _week_start_postgresql(element, compiler, **kw):
+    day = compiler.process(element.clauses, **kw)
+    return f"CAST(date_trunc('week', {day}) AS DATE)"
+
+
+@compiles(month_start)
+def _month_start(element, compiler, **kw):
+    day = compiler.process(element.clauses, **kw)
+    return f"date({day}, 'start of month')"
+
+
+@compiles(month_start, "postgresql")
+def _month_start_postgresql(element, compiler, **kw):
+    day = compiler.process(element.clauses, **kw)
+    return f"CAST(date_trunc('month', {day}) AS DATE)"
+
+
+# first day of the period of a day column
+_PERIOD_START = {
+    "day": lambda column: column,
+    "week": week_start,
+    "month": month_start,
+}
 
 
 class FinancialReport(BaseModel):
@@ -16,52 +101,605 @@ class FinancialReport(BaseModel):
     status: str
 
 
+class ClinicFinancialReport(BaseModel):
+    doctor_id: int
+    period: date
+    total_value: float
+    procedures: int
+    status: str
+
+
+BreakdownDimension = typing.Literal["doctor_id", "status", "month", "patient_id"]
+
+
+class FinancialBreakdown(BaseModel):
+    """
+    Row of the financial breakdown, with only the grouped dimensions set.
+    """
+
+    doctor_id: int | None = None
+    status: str | None = None
+    month: date | None = None
+    patient_id: int | None = None
+    procedures: int
+    total_value: float
+    glossed_value: float
+    glosa_rate: float
+    percentiles: dict[str, float]
+
+
 class NewProcedure(BaseModel):
-    doctor_id: typing.Annotated[int, AfterValidator(doctor_exists)]
-    patient_id: typing.Annotated[int, AfterValidator(patient_exists)]
+    doctor_id: typing.Annotated[int, AfterValidator(positive_id("Doctor"))]
+    patient_id: typing.Annotated[int, AfterValidator(positive_id("Patient"))]
     date: date
     value: typing.Annotated[float, AfterValidator(value_is_number)]
     payment_status: typing.Literal["paid", "pending", "glossed"]
 
 
-class ProcedureDetail(NewProcedure):
+class ProcedureDetail(BaseModel):
+    """
+    Read model of a procedure. Built straight from ORM objects or Core
+    rows, without the database validators of `NewProcedure`.
+    """
+
     model_config = ConfigDict(from_attributes=True)
 
+    doctor_id: int
+    patient_id: int
+    date: date
+    value: float
+    payment_status: typing.Literal["paid", "pending", "glossed"]
     id: int
 
 
+# converters of the `Procedure.report_query` columns to the fields of
+# `ProcedureDetail`, to serialize the rows without building the models
+PROCEDURE_DETAIL_CONVERTERS = {"date": lambda value: value.date()}
+
+
+class BulkProcedure(BaseModel):
+    """
+    Procedure row of the bulk registry. The doctor and patient ids are
+    checked for the whole chunk at once, not by validators on each row.
+    """
+
+    doctor_id: int
+    patient_id: int
+    date: date
+    value: typing.Annotated[float, AfterValidator(value_is_number)]
+    payment_status: typing.Literal["paid", "pending", "glossed"]
+
+
+class BulkProcedureResult(BaseModel):
+    index: int
+    status: typing.Literal["created", "error"]
+    id: int | None = None
+    error: str | None = None
+
+
+class ProcedureStatusUpdate(BaseModel):
+    payment_status: typing.Literal["paid", "pending", "glossed"]
+    ids: list[int] | None = None
+    doctor_id: int | None = None
+    start: date | None = None
+    end: date | None = None
+    current_status: typing.Literal["paid", "pending", "glossed"] | None = None
+
+    @model_validator(mode="after")
+    def check_filters(self):
+        if not (self.ids or self.doctor_id or self.start or self.end):
+            raise ValueError("Inform the ids, the doctor or the period to update.")
+        return self
+
+
+class ProcedureStatusResult(BaseModel):
+    updated: int
+    ids: list[int]
+
+
 class GlossedReport(BaseModel):
     start: date
     end: date
 
 
 class Procedure(Base):
+    """
+    On postgres the table is partitioned by month on `date` (see the
+    partition migration), with a default partition for rows outside the
+    monthly ones. Report queries filter `date` by range so the planner
+    only scans the partitions of the period.
+    """
+
     __tablename__ = "procedures"
+    __table_args__ = (
+        # daily/glossed reports by doctor
+        Index("ix_procedures_doctor_id_date", "doctor_id", "date"),
+        # glossed report of every doctor
+        Index("ix_procedures_payment_status_date", "payment_status", "date"),
+        # financial report, answered from the index only
+        Index(
+            "ix_procedures_doctor_id_payment_status",
+            "doctor_id",
+            "payment_status",
+            postgresql_include=["value"],
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     doctor_id = Column(Integer, ForeignKey("doctors.id"), nullable=False)
     patient_id = Column(Integer, ForeignKey("patients.id"), nullable=False)
     date = Column(DateTime, nullable=False)
     value = Column(Numeric(10, 2), nullable=False)
-    payment_status = Column(
-        Enum("paid", "pending", "glossed", name="payment_status"), nullable=False
-    )
+    payment_status = Column(PAYMENT_STATUS, nullable=False)
 
     doctor = relationship("Doctor", back_populates="procedures")
     patient = relationship("Patient", back_populates="procedures")
 
     @classmethod
-    def get_financial_report(cls, doctor_id: int) -> list[FinancialReport]:
+    def bulk_create(cls, rows: list[dict]) -> list[int]:
+        """
+        Insert the rows with a multi-row INSERT in a single transaction.
+
+        @Return:
+            - IDs of the created procedures, in the same order of the rows
+        """
+        if not rows:
+            return []
+
+        ids = cls._database.scalars(
+            insert(cls).returning(cls.id, sort_by_parameter_order=True), rows
+        ).all()
+        # core inserts skip the mapper events that keep the rollups
+        ProcedureRollup.apply(
+            cls._database,
+            [
+                (
+                    row["doctor_id"],
+                    row["payment_status"],
+                    row["date"],
+                    row["value"],
+                    1,
+                )
+                for row in rows
+            ],
+        )
+        cls.commit()
+        return ids
+
+    @classmethod
+    def update_status(
+        cls,
+        payment_status: str,
+        current_status: str | None = None,
+        chunk_size: int = 1000,
+        **filters,
+    ) -> list[int]:
+        """
+        Change the payment status of the procedures matching the filters.
+
+        Runs one `UPDATE ... WHERE id IN (chunk) RETURNING` and one commit
+        per chunk, for each previous status, keeping the rollups in the
+        same transaction.
+
+        @Params:
+            - payment_status: New status
+            - current_status: Only update procedures with this status
+            - filters: Same filters of `Base.filter` (e.g. `id__in`,
+                `date__gte`)
+
+        @Return:
+            - IDs of the updated procedures
+        """
+        clauses = cls._filter_clauses(filters)
+
+        previous_statuses = (
+            [current_status] if current_status else PAYMENT_STATUS.enums
+        )
+
+        updated = []
+        for previous_status in previous_statuses:
+            if previous_status == payment_status:
+                continue
+
+            matching = [*clauses, cls.payment_status == previous_status]
+            while True:
+                chunk = (
+                    select(cls.id)
+                    .where(*matching)
+                    .order_by(cls.id)
+                    .limit(chunk_size)
+                    .with_for_update()
+                    .scalar_subquery()
+                )
+                rows = cls._database.execute(
+                    update(cls)
+                    .where(cls.id.in_(chunk), *matching)
+                    .values(payment_status=payment_status)
+                    .returning(cls.id, cls.doctor_id, cls.date, cls.value)
+                    .execution_options(synchronize_session=False)
+                ).all()
+
+                # core updates skip the mapper events that keep the rollups
+                ProcedureRollup.apply(
+                    cls._database,
+                    [
+                        delta
+                        for row in rows
+                        for delta in (
+                            (row.doctor_id, previous_status, row.date, -row.value, -1),
+                            (row.doctor_id, payment_status, row.date, row.value, 1),
+                        )
+                    ],
+                )
+                cls.commit()
+                updated += [row.id for row in rows]
+
+                if len(rows) < chunk_size:
+                    break
+
+        return updated
+
+    @classmethod
+    def report_query(
+        cls, after: tuple | None = None, limit: int | None = None, **filters
+    ):
+        """
+        Select the procedures matching the filters as Core rows, ordered by
+        (date, id) so they can be paginated by keyset.
+
+        @Params:
+            - after: (date, id) of the last row of the previous page
+            - limit: Max number of rows
+            - filters: Same filters of `Base.filter`
+        """
+        statement = (
+            select(*cls.__table__.c)
+            .where(*cls._filter_clauses(filters))
+            .order_by(cls.date, cls.id)
+        )
+        if after:
+            # the plain date bound lets postgres prune the earlier
+            # partitions, which the row comparison alone does not
+            statement = statement.where(
+                cls.date >= after[0], tuple_(cls.date, cls.id) > after
+            )
+        if limit:
+            statement = statement.limit(limit)
+        return statement
+
+    @classmethod
+    async def aget_report_page(
+        cls, cursor: str | None, limit: int, replica: bool = False, **filters
+    ) -> tuple[list, str | None]:
+        """
+        Get a page of the report and the cursor of the next page.
+        """
+        after = decode_cursor(cursor) if cursor else None
+        rows = await cls.afetch(
+            cls.report_query(after=after, limit=limit + 1, **filters), replica
+        )
+        if len(rows) <= limit:
+            return rows, None
+
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1].date, rows[-1].id)
+
+    @classmethod
+    def stream_report(
+        cls, batch_size: int = 1000, replica: bool = False, **filters
+    ):
+        """
+        Yield the report rows in batches, using a server-side cursor so the
+        whole report is never held in memory.
+        """
+        session = get_read_session() if replica else cls._database
+        result = session.execute(
+            cls.report_query(**filters).execution_options(yield_per=batch_size)
+        )
+        yield from result.partitions()
+
+    @classmethod
+    def create_partitions(cls, months: int = 3) -> list[str]:
+        """
+        Create the monthly partitions from the current month up to `months`
+        ahead, when missing. Only for postgres, where the table is
+        partitioned; rows of a new month already in the default partition
+        are moved to it.
+
+        @Return:
+            - Names of the created partitions
+        """
+        session = cls._database
+        if session.get_bind().dialect.name != "postgresql":
+            return []
+
+        created = []
+        month = date.today().replace(day=1)
+        for _ in range(months + 1):
+            following = (month + timedelta(days=32)).replace(day=1)
+            name = f"procedures_y{month:%Y}m{month:%m}"
+            if session.scalar(text("SELECT to_regclass(:name)"), {"name": name}):
+                month = following
+                continue
+
+            session.execute(
+                text(f"CREATE TABLE {name} (LIKE procedures INCLUDING DEFAULTS)")
+            )
+            session.execute(
+                text(
+                    "WITH moved AS ("
+                    "DELETE FROM procedures_default "
+                    "WHERE date >= :start AND date < :end RETURNING *"
+                    f") INSERT INTO {name} SELECT * FROM moved"
+                ),
+                {"start": month, "end": following},
+            )
+            session.execute(
+                text(
+                    f"ALTER TABLE procedures ATTACH PARTITION {name} "
+                    f"FOR VALUES FROM ('{month}') TO ('{following}')"
+                )
+            )
+            cls.commit()
+            created.append(name)
+            month = following
+        return created
+
+    @classmethod
+    def get_financial_report(
+        cls,
+        doctor_id: int | None = None,
+        start: date | None = None,
+        end: date | None = None,
+        period: ReportPeriod | None = None,
+        replica: bool = False,
+    ) -> list[FinancialReport]:
         """
         Get financial report of procedures by doctor.
+
+        Read from the daily rollups, so it costs a few rows per day in the
+        period instead of a scan of every procedure of the doctor.
+
+        @Params:
+            - doctor_id: Doctor of the report. When None, the totals of
+                every doctor are grouped by `doctor_id` in the same query
+            - start, end: Period of the report (days included)
+            - period: Also group the totals by day, week or month, in a
+                `period` column with the first day of each period
+            - replica: Read from the read replica, when configured
+        """
+        return cls.fetch(
+            cls._financial_report_query(doctor_id, start, end, period), replica
+        )
+
+    @classmethod
+    async def aget_financial_report(
+        cls,
+        doctor_id: int | None = None,
+        start: date | None = None,
+        end: date | None = None,
+        period: ReportPeriod | None = None,
+        replica: bool = False,
+    ) -> list[FinancialReport]:
         """
+        Async version of `get_financial_report`.
+        """
+        return await cls.afetch(
+            cls._financial_report_query(doctor_id, start, end, period), replica
+        )
+
+    @classmethod
+    def _financial_report_query(
+        cls,
+        doctor_id: int | None,
+        start: date | None,
+        end: date | None,
+        period: ReportPeriod | None = None,
+    ):
+        rollup = ProcedureRollup
+        groups = []
+        if doctor_id is None:
+            groups.append(rollup.doctor_id)
+        if period:
+            groups.append(_PERIOD_START[period](rollup.day).label("period"))
+        groups.append(rollup.payment_status.label("status"))
+
+        statement = select(
+            func.sum(rollup.total_value).label("total_value"),
+            func.sum(rollup.procedures).label("procedures"),
+            *groups,
+        )
+        if doctor_id is not None:
+            statement = statement.where(rollup.doctor_id == doctor_id)
+        if start:
+            statement = statement.where(rollup.day >= start)
+        if end:
+            statement = statement.where(rollup.day <= end)
+
         return (
-            cls._database.query(
-                func.sum(cls.value).label("total_value"),
-                func.count(cls.id).label("procedures"),
-                cls.payment_status.label("status"),
+            statement.group_by(*groups)
+            .having(func.sum(rollup.procedures) > 0)
+            .order_by(*groups)
+        )
+
+
+class ProcedureRollup(Base):
+    """
+    Totals of the procedures by doctor, payment status and day.
+
+    Kept in the same transaction of every change on `procedures`: ORM
+    changes through mapper events and core statements (bulk insert, status
+    updates) by calling `apply` explicitly. `apply` also invalidates the
+    cached reports of the changed doctors and days.
+    """
+
+    __tablename__ = "procedure_rollups"
+
+    doctor_id = Column(Integer, ForeignKey("doctors.id"), primary_key=True)
+    payment_status = Column(PAYMENT_STATUS, primary_key=True)
+    day = Column(Date, primary_key=True)
+    total_value = Column(Numeric(14, 2), nullable=False, default=0)
+    procedures = Column(Integer, nullable=False, default=0)
+
+    @classmethod
+    def apply(cls, session: Session, deltas) -> None:
+        """
+        Add deltas to the rollups with an upsert.
+
+        @Params:
+            - session: Session of the transaction changing procedures
+            - deltas: (doctor_id, payment_status, date, value, count) tuples.
+                Removed procedures have negative value and count
+        """
+        totals = defaultdict(lambda: [Decimal(0), 0])
+        removed = False
+        for doctor_id, payment_status, procedure_date, value, count in deltas:
+            total = totals[(doctor_id, payment_status, _day(procedure_date))]
+            total[0] += Decimal(str(value))
+            total[1] += count
+            removed = removed or count < 0
+
+        if not totals:
+            return
+
+        REPORT_CACHE.mark_changed(
+            session, {(doctor_id, day) for doctor_id, _, day in totals}
+        )
+        if removed:
+            # updated or deleted procedures, which the in-memory aggregates
+            # can not append (see `procedure_aggregates`)
+            session.info[ROWS_REMOVED_KEY] = True
+
+        # the connection of the transaction, also while flushing
+        connection = session.connection()
+        table = cls.__table__
+        dialect_insert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}[
+            connection.dialect.name
+        ]
+        # sorted, so concurrent transactions lock the rows in the same order
+        statement = dialect_insert(table).values(
+            [
+                {
+                    "doctor_id": doctor_id,
+                    "payment_status": payment_status,
+                    "day": day,
+                    "total_value": total[0],
+                    "procedures": total[1],
+                }
+                for (doctor_id, payment_status, day), total in sorted(totals.items())
+            ]
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.doctor_id, table.c.payment_status, table.c.day],
+            set_={
+                "total_value": table.c.total_value + statement.excluded.total_value,
+                "procedures": table.c.procedures + statement.excluded.procedures,
+            },
+        )
+        connection.execute(statement)
+
+    @classmethod
+    def rebuild(cls) -> int:
+        """
+        Recompute every rollup from the procedures table.
+
+        @Return:
+            - Number of rollup rows
+        """
+        day = func.date(Procedure.date)
+        cls._database.execute(delete(cls))
+        cls._database.execute(
+            insert(cls).from_select(
+                ["doctor_id", "payment_status", "day", "total_value", "procedures"],
+                select(
+                    Procedure.doctor_id,
+                    Procedure.payment_status,
+                    day,
+                    func.sum(Procedure.value),
+                    func.count(Procedure.id),
+                ).group_by(Procedure.doctor_id, Procedure.payment_status, day),
             )
-            .filter(cls.doctor_id == doctor_id)
-            .group_by(cls.payment_status)
-            .all()
         )
+        cls.commit()
+        return cls._database.scalar(select(func.count()).select_from(cls))
+
+
+def _day(value: date | datetime) -> date:
+    return value.date() if isinstance(value, datetime) else value
+
+
+_ROLLUP_KEYS = ("doctor_id", "payment_status", "date", "value")
+
+
+def _rollup_values(target: Procedure, previous: bool = False) -> tuple:
+    if not previous:
+        return tuple(getattr(target, key) for key in _ROLLUP_KEYS)
+
+    state = inspect(target)
+    values = []
+    for key in _ROLLUP_KEYS:
+        history = state.attrs[key].history
+        values.append(history.deleted[0] if history.deleted else getattr(target, key))
+    return tuple(values)
+
+
+@event.listens_for(Procedure, "after_insert")
+def _rollup_insert(mapper, connection, target: Procedure) -> None:
+    ProcedureRollup.apply(object_session(target), [(*_rollup_values(target), 1)])
+
+
+@event.listens_for(Procedure, "after_update")
+def _rollup_update(mapper, connection, target: Procedure) -> None:
+    previous = _rollup_values(target, previous=True)
+    current = _rollup_values(target)
+    if previous == current:
+        return
+
+    doctor_id, payment_status, procedure_date, value = previous
+    ProcedureRollup.apply(
+        object_session(target),
+        [
+            (doctor_id, payment_status, procedure_date, -Decimal(str(value)), -1),
+            (*current, 1),
+        ],
+    )
+
+
+@event.listens_for(Procedure, "after_delete")
+def _rollup_delete(mapper, connection, target: Procedure) -> None:
+    doctor_id, payment_status, procedure_date, value = _rollup_values(
+        target, previous=True
+    )
+    ProcedureRollup.apply(
+        object_session(target),
+        [(doctor_id, payment_status, procedure_date, -Decimal(str(value)), -1)],
+    )
+
+
+def period_filters(start: date, end: date) -> dict:
+    """
+    Get the `Base.filter` lookups of the procedures from `start` to `end`
+    (days included).
+    """
+    # `date` is a timestamp, so the days are a half-open range, which also
+    # lets postgres prune the monthly partitions outside of it
+    return {"date__gte": start, "date__lt": end + timedelta(days=1)}
+
+
+def encode_cursor(procedure_date: datetime, procedure_id: int) -> str:
+    """
+    Encode the keyset of a report row into an opaque cursor.
+    """
+    raw = json.dumps([procedure_date.isoformat(), procedure_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """
+    Decode a cursor created by `encode_cursor`.
+    """
+    try:
+        procedure_date, procedure_id = json.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(procedure_date), int(procedure_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
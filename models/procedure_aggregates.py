@@ -0,0 +1,304 @@
+"""
+In-memory aggregation of the procedures with NumPy, for the financial
+breakdowns by doctor, status, month and patient.
+
+The procedures are loaded once into NumPy columns and kept fresh on use:
+every `refresh_seconds`, the procedures with an id above the newest one
+seen `overlap_seconds` before are read again and the ones not loaded yet
+are appended, and the whole table is reloaded every
+`full_refresh_seconds` or after this worker updated or deleted procedures.
+
+Ids are taken before the COMMIT, so a procedure can show up after others
+with higher ids: the overlap catches those whose transaction lasted less
+than `overlap_seconds`. Updates done by other workers, and procedures
+committed while the first load ran, show after the next full reload.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from datetime import date
+
+import numpy as np
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .engine import session_scope
+from .procedure import PAYMENT_STATUS, ROWS_REMOVED_KEY
+from .procedure_export import record_batches
+
+_GLOSSED = PAYMENT_STATUS.enums.index("glossed")
+# value is in cents, so the sums are exact
+_DTYPES = {
+    "id": np.int64,
+    "doctor_id": np.int32,
+    "patient_id": np.int32,
+    "day": "datetime64[D]",
+    "value": np.int64,
+    "status": np.int8,
+}
+
+
+class ProcedureAggregates:
+    """
+    Columns of the procedures in NumPy arrays, grouped with vectorized
+    sums, counts and quantiles.
+
+    The arrays are never changed in place: a sync builds new ones and
+    swaps them, so a breakdown always sees a consistent snapshot.
+    """
+
+    def __init__(
+        self,
+        refresh_seconds: float = 30,
+        full_refresh_seconds: float = 900,
+        overlap_seconds: float = 300,
+        batch_size: int = 65536,
+    ):
+        self.refresh_seconds = refresh_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self.overlap_seconds = overlap_seconds
+        self.batch_size = batch_size
+        self._columns = _empty_columns()
+        # (time, newest id) of the syncs, back to `overlap_seconds` ago
+        self._watermarks: deque[tuple[float, int]] = deque()
+        self._synced_at: float | None = None
+        self._loaded_at: float | None = None
+        self._stale = True
+        self._lock = threading.Lock()
+
+    @property
+    def rows(self) -> int:
+        return len(self._columns["id"])
+
+    def mark_stale(self) -> None:
+        """
+        Reload every procedure on the next sync.
+        """
+        self._stale = True
+
+    def sync(self, force: bool = False) -> None:
+        """
+        Append the new procedures, or reload all of them, when the columns
+        are older than the refresh intervals (or always, with `force`).
+        """
+        if not (force or self._needs_sync()):
+            return
+
+        with self._lock:
+            # synced by another thread while waiting for the lock
+            if not (force or self._needs_sync()):
+                return
+
+            started = time.monotonic()
+            if (
+                force
+                or self._stale
+                or self._loaded_at is None
+                or started - self._loaded_at >= self.full_refresh_seconds
+            ):
+                # cleared first, so changes committed during the load
+                # trigger another one
+                self._stale = False
+                self._columns = _load(self.batch_size)
+                self._loaded_at = started
+            else:
+                since = self._overlap_start(started)
+                new = _load(self.batch_size, id__gt=since)
+                ids = self._columns["id"]
+                added = ~np.isin(new["id"], ids[ids > since])
+                self._columns = {
+                    name: np.concatenate((column, new[name][added]))
+                    for name, column in self._columns.items()
+                }
+
+            ids = self._columns["id"]
+            self._watermarks.append((started, int(ids.max()) if len(ids) else 0))
+            self._synced_at = started
+
+    def breakdown(
+        self,
+        by: list[str] | tuple = ("doctor_id", "status"),
+        doctor_id: int | None = None,
+        status: str | None = None,
+        start: date | None = None,
+        end: date | None = None,
+        percentiles: list[float] | tuple = (0.5, 0.9),
+    ) -> list[dict]:
+        """
+        Group the procedures by the dimensions in `by`.
+
+        @Params:
+            - by: Any of doctor_id, status, month and patient_id. Empty for
+                the totals of every procedure
+            - doctor_id, status: Only the procedures of the doctor/status
+            - start, end: Period of the procedures (days included)
+            - percentiles: Fractions (0 to 1) of the value quantiles
+
+        @Return:
+            Rows with the dimensions, the number of procedures, their total
+            value, the glossed value, the glosa rate (glossed / total value)
+            and the value percentiles, ordered by the dimensions
+        """
+        columns = self._columns
+        mask = np.ones(len(columns["id"]), dtype=bool)
+        if doctor_id is not None:
+            mask &= columns["doctor_id"] == doctor_id
+        if status is not None:
+            mask &= columns["status"] == PAYMENT_STATUS.enums.index(status)
+        if start is not None:
+            mask &= columns["day"] >= np.datetime64(start, "D")
+        if end is not None:
+            mask &= columns["day"] <= np.datetime64(end, "D")
+
+        values = columns["value"][mask]
+        if not len(values):
+            return []
+        glossed = columns["status"][mask] == _GLOSSED
+
+        # each dimension is coded 0..n-1, and the codes are combined in a
+        # single integer key, much faster to sort than rows of keys
+        uniques = []
+        key = np.zeros(len(values), dtype=np.int64)
+        for name in by:
+            unique, codes = np.unique(
+                _dimension(columns, name)[mask], return_inverse=True
+            )
+            uniques.append(unique)
+            key = key * len(unique) + codes
+        group_keys, inverse = np.unique(key, return_inverse=True)
+        groups = (
+            np.unravel_index(group_keys, [len(unique) for unique in uniques])
+            if by
+            else ()
+        )
+
+        size = len(group_keys)
+        counts = np.bincount(inverse, minlength=size)
+        totals = np.bincount(inverse, weights=values, minlength=size)
+        glossed_totals = np.bincount(
+            inverse, weights=np.where(glossed, values, 0), minlength=size
+        )
+        rates = np.divide(
+            glossed_totals, totals, out=np.zeros(size), where=totals != 0
+        )
+        quantiles = _group_quantiles(inverse, values, counts, percentiles)
+
+        labels = [
+            _labels(name, unique[codes])
+            for name, unique, codes in zip(by, uniques, groups)
+        ]
+        percentile_names = [f"p{fraction * 100:g}" for fraction in percentiles]
+        rows = []
+        for index in range(size):
+            row = {name: labels[i][index] for i, name in enumerate(by)}
+            row["procedures"] = int(counts[index])
+            row["total_value"] = round(float(totals[index]) / 100, 2)
+            row["glossed_value"] = round(float(glossed_totals[index]) / 100, 2)
+            row["glosa_rate"] = float(rates[index])
+            row["percentiles"] = {
+                name: round(float(quantile[index]) / 100, 2)
+                for name, quantile in zip(percentile_names, quantiles)
+            }
+            rows.append(row)
+        return rows
+
+    def _overlap_start(self, now: float) -> int:
+        """
+        Get the newest id of the last sync at least `overlap_seconds` old
+        (of the oldest one, when none is that old).
+        """
+        watermarks = self._watermarks
+        while len(watermarks) > 1 and watermarks[1][0] <= now - self.overlap_seconds:
+            watermarks.popleft()
+        return watermarks[0][1] if watermarks else 0
+
+    def _needs_sync(self) -> bool:
+        return (
+            self._stale
+            or self._synced_at is None
+            or time.monotonic() - self._synced_at >= self.refresh_seconds
+        )
+
+
+def _empty_columns() -> dict[str, np.ndarray]:
+    return {name: np.empty(0, dtype=dtype) for name, dtype in _DTYPES.items()}
+
+
+def _load(batch_size: int, **filters) -> dict[str, np.ndarray]:
+    """
+    Read the procedures matching the filters into NumPy columns, from the
+    Arrow batches of the export.
+    """
+    parts = {name: [] for name in _DTYPES}
+    with session_scope():
+        for batch in record_batches(batch_size, replica=True, **filters):
+            for name in ("id", "doctor_id", "patient_id"):
+                parts[name].append(batch.column(name).to_numpy())
+            parts["day"].append(batch.column("date").to_numpy(zero_copy_only=False))
+            values = batch.column("value").cast("float64").to_numpy()
+            parts["value"].append(np.rint(values * 100).astype(np.int64))
+            parts["status"].append(batch.column("payment_status").indices.to_numpy())
+
+    return {
+        name: np.concatenate(chunks).astype(_DTYPES[name], copy=False)
+        if chunks
+        else np.empty(0, dtype=_DTYPES[name])
+        for name, chunks in parts.items()
+    }
+
+
+def _dimension(columns: dict, name: str) -> np.ndarray:
+    if name == "month":
+        return columns["day"].astype("datetime64[M]")
+    return columns[name]
+
+
+def _labels(name: str, keys: np.ndarray) -> list:
+    if name == "status":
+        return [PAYMENT_STATUS.enums[key] for key in keys.tolist()]
+    if name == "month":
+        return keys.astype("datetime64[M]").astype("datetime64[D]").tolist()
+    return keys.tolist()
+
+
+def _group_quantiles(groups, values, counts, fractions) -> list[np.ndarray]:
+    """
+    Get the quantiles of the values of each group, interpolated linearly
+    like `np.quantile`, with a single sort for all the groups.
+    """
+    # sorted by group then value with one argsort on a combined key, a lot
+    # faster than `np.lexsort`; cents stay far below the int64 limit
+    offset = values - values.min()
+    ordered = values[np.argsort(groups * (int(offset.max()) + 1) + offset)]
+    starts = np.cumsum(counts) - counts
+    quantiles = []
+    for fraction in fractions:
+        position = starts + fraction * (counts - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        weight = position - lower
+        quantiles.append(ordered[lower] * (1 - weight) + ordered[upper] * weight)
+    return quantiles
+
+
+PROCEDURE_AGGREGATES = ProcedureAggregates(
+    refresh_seconds=float(os.getenv("AGGREGATES_REFRESH", 30)),
+    full_refresh_seconds=float(os.getenv("AGGREGATES_FULL_REFRESH", 900)),
+    overlap_seconds=float(os.getenv("AGGREGATES_OVERLAP", 300)),
+    batch_size=int(os.getenv("AGGREGATES_BATCH_SIZE", 65536)),
+)
+
+
+# after the COMMIT: a full reload started before it would read the old
+# rows and clear the stale mark
+@event.listens_for(Session, "after_commit")
+def _reload_on_commit(session: Session) -> None:
+    if session.info.pop(ROWS_REMOVED_KEY, False):
+        PROCEDURE_AGGREGATES.mark_stale()
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session) -> None:
+    session.info.pop(ROWS_REMOVED_KEY, None)
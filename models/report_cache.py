@@ -0,0 +1,125 @@
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from core.metrics import CACHE_METRICS
+
+from .cache import TTLCache
+
+_PENDING_KEY = "report_cache_pending"
+
+
+class ReportCache:
+    """
+    Cache of serialized report responses.
+
+    Keys are `(report, doctor_id, start, end)`; `doctor_id` None means
+    every doctor and open `start`/`end` an unbounded period. Writes to
+    procedures mark the changed (doctor, day) on their session, and the
+    matching entries are dropped once the transaction committed, so a
+    report read afterwards sees the changes.
+
+    The backend only needs the `TTLCache` interface (get, set,
+    invalidate_keys, clear, stats), so it can be swapped for a shared one.
+    Entries are per worker: the TTL bounds how stale other workers are.
+
+    The time of the last commit changing each doctor is kept too, so the
+    reports read a replica only once it had time to catch up.
+    """
+
+    def __init__(self, backend: TTLCache):
+        self.backend = backend
+        # bumped on every invalidation, so a report read before a write
+        # commits is not cached after the invalidation
+        self.generation = 0
+        # doctor_id -> monotonic time of its last change, None for any doctor
+        self._changed_at: dict[int | None, float] = {}
+
+    def get(self, key: tuple) -> bytes | None:
+        return self.backend.get(key)
+
+    def set(self, key: tuple, body: bytes, generation: int) -> None:
+        """
+        Cache a report read when the cache was at `generation`.
+        """
+        if generation == self.generation:
+            self.backend.set(key, body)
+
+    def mark_changed(self, session: Session, changes) -> None:
+        """
+        Register (doctor_id, day) pairs changed in the session transaction.
+        """
+        session.info.setdefault(_PENDING_KEY, set()).update(changes)
+
+    def invalidate(self, changes) -> None:
+        """
+        Drop the reports covering any of the changed (doctor_id, day) pairs,
+        with a single scan of the cache.
+        """
+        days = defaultdict(set)
+        for doctor_id, day in changes:
+            days[doctor_id].add(day)
+            # the reports of every doctor
+            days[None].add(day)
+        if not days:
+            return
+        days = {doctor_id: sorted(changed) for doctor_id, changed in days.items()}
+
+        def affected(key: tuple) -> bool:
+            _, key_doctor_id, start, end = key
+            changed = days.get(key_doctor_id)
+            if changed is None:
+                return False
+            # first changed day from the start of the report
+            index = bisect_left(changed, start) if start is not None else 0
+            return index < len(changed) and (end is None or changed[index] <= end)
+
+        self.generation += 1
+        self.backend.invalidate_keys(affected)
+        now = time.monotonic()
+        for doctor_id in days:
+            self._changed_at[doctor_id] = now
+
+    def changed_within(self, doctor_id: int | None, seconds: float) -> bool:
+        """
+        Check if the procedures of the doctor (any doctor when None) changed
+        in the last `seconds`, on this worker.
+        """
+        changed_at = self._changed_at.get(doctor_id)
+        return changed_at is not None and time.monotonic() - changed_at < seconds
+
+    def clear(self) -> None:
+        self.generation += 1
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        return self.backend.stats()
+
+
+REPORT_CACHE = ReportCache(
+    TTLCache(
+        maxsize=int(os.getenv("REPORT_CACHE_SIZE", 1024)),
+        ttl=float(os.getenv("REPORT_CACHE_TTL", 30)),
+        maxbytes=int(os.getenv("REPORT_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+        sizeof=len,
+    )
+)
+
+
+CACHE_METRICS.add(REPORT_CACHE.stats, "report")
+
+
+# after the COMMIT: invalidated before it, a report read in between would
+# cache the old rows again
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session: Session) -> None:
+    REPORT_CACHE.invalidate(session.info.pop(_PENDING_KEY, ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session) -> None:
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,319 @@
+import gzip
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+import typing
+import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime
+
+import orjson
+from pydantic import BaseModel, model_validator
+
+from core.responses import dumps, row_dicts
+
+# every mapped model, so the mappers can be configured in the spawned
+# workers, which only import this module
+from . import doctor, patient, user  # noqa: F401
+from .engine import session_scope
+from .procedure import (
+    PROCEDURE_DETAIL_CONVERTERS,
+    Procedure,
+    ReportPeriod,
+    period_filters,
+)
+
+logger = logging.getLogger(__name__)
+
+# rows fetched (and written) between two progress updates
+JOB_BATCH_SIZE = int(os.getenv("REPORT_JOB_BATCH_SIZE", 5000))
+
+JobStatus = typing.Literal["pending", "running", "done", "failed"]
+
+_JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class ReportJobRequest(BaseModel):
+    report: typing.Literal["glossed", "financial"]
+    doctor_id: int | None = None
+    start: date | None = None
+    end: date | None = None
+    period: ReportPeriod | None = None
+
+    @model_validator(mode="after")
+    def check_period(self):
+        if self.report == "glossed" and not (self.start and self.end):
+            raise ValueError("Inform the start and end of the glossed report.")
+        return self
+
+    def params(self) -> dict:
+        params = {"doctor_id": self.doctor_id, "start": self.start, "end": self.end}
+        if self.report == "financial":
+            params["period"] = self.period
+        return params
+
+
+class ReportJob(BaseModel):
+    id: str
+    report: str
+    params: dict
+    status: JobStatus
+    rows: int
+    total: int | None
+    progress: float | None
+    error: str | None
+    created_at: datetime
+    expires_at: datetime
+
+
+class ReportJobs:
+    """
+    Run long reports in a pool of background workers.
+
+    The files of a job live in `directory`: its parameters, progress, the
+    result (gzipped JSON) or the error. Any app worker of the host can then
+    tell the status and serve the result, until the job expires `ttl`
+    seconds after it was submitted. Identical jobs still running on this
+    worker are only submitted once.
+
+    `executor` is "thread" or "process". Process workers start with their
+    own engines, which keeps the heavy reports off the GIL of the app.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        workers: int = 2,
+        executor: typing.Literal["thread", "process"] = "thread",
+        ttl: float = 3600,
+    ):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown report job executor: {executor}")
+
+        self.directory = directory
+        self.workers = workers
+        self.executor = executor
+        self.ttl = ttl
+        self._pool: Executor | None = None
+        # (report, params) -> id of the job running them
+        self._running: dict[tuple, str] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, report: str, params: dict) -> str:
+        """
+        Submit a report job, or get the id of the identical one running.
+        """
+        key = (report, tuple(sorted(params.items())))
+        with self._lock:
+            job_id = self._running.get(key)
+            if job_id is not None:
+                return job_id
+
+            os.makedirs(self.directory, exist_ok=True)
+            self.sweep()
+
+            job_id = uuid.uuid4().hex
+            job = {
+                "id": job_id,
+                "report": report,
+                "params": params,
+                "created_at": time.time(),
+            }
+            _write_json(self._path(job_id, "job.json"), job)
+            future = self._get_pool().submit(
+                run_report_job, self._path(job_id, ""), report, params
+            )
+            self._running[key] = job_id
+
+        future.add_done_callback(lambda done: self._finish(key, job_id, done))
+        return job_id
+
+    def status(self, job_id: str) -> dict | None:
+        """
+        Get the status of a job, None when it does not exist or expired.
+        """
+        job = self._read(job_id, "job.json")
+        if job is None:
+            return None
+
+        expires_at = job["created_at"] + self.ttl
+        if expires_at < time.time():
+            self._delete(job_id)
+            return None
+
+        error = self._read(job_id, "error.json")
+        progress = self._read(job_id, "progress.json")
+        if error is not None:
+            status = "failed"
+        elif os.path.exists(self._path(job_id, "json.gz")):
+            status = "done"
+        else:
+            status = "running" if progress is not None else "pending"
+
+        progress = progress or {"rows": 0, "total": None}
+        rows, total = progress["rows"], progress["total"]
+        if status == "done":
+            fraction = 1.0
+        else:
+            fraction = rows / total if total else None
+        return {
+            **job,
+            "status": status,
+            "rows": rows,
+            "total": total,
+            "progress": fraction,
+            "error": error and error["message"],
+            "created_at": datetime.fromtimestamp(job["created_at"]),
+            "expires_at": datetime.fromtimestamp(expires_at),
+        }
+
+    def result_path(self, job_id: str) -> str | None:
+        """
+        Get the gzipped JSON result of a finished job.
+        """
+        path = self._path(job_id, "json.gz")
+        if path is None or not os.path.exists(path):
+            return None
+        return path
+
+    def sweep(self) -> int:
+        """
+        Delete the files of the expired jobs, returning how many expired.
+        """
+        expired = 0
+        for name in os.listdir(self.directory):
+            job_id, _, suffix = name.partition(".")
+            if suffix != "job.json":
+                continue
+            job = self._read(job_id, suffix)
+            if job is not None and job["created_at"] + self.ttl < time.time():
+                self._delete(job_id)
+                expired += 1
+        return expired
+
+    def shutdown(self) -> None:
+        """
+        Stop the workers; the pending jobs are cancelled.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _get_pool(self) -> Executor:
+        if self._pool is None:
+            if self.executor == "process":
+                # spawned, so no pooled connection is shared with the app
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._pool = ThreadPoolExecutor(
+                    self.workers, thread_name_prefix="report-job"
+                )
+        return self._pool
+
+    def _finish(self, key: tuple, job_id: str, future) -> None:
+        with self._lock:
+            if self._running.get(key) == job_id:
+                del self._running[key]
+
+        if future.cancelled():
+            _write_json(
+                self._path(job_id, "error.json"),
+                {"message": "Cancelled on shutdown."},
+            )
+
+    def _path(self, job_id: str, suffix: str) -> str | None:
+        # job ids come from the URL
+        if not _JOB_ID.fullmatch(job_id):
+            return None
+        return os.path.join(self.directory, f"{job_id}.{suffix}")
+
+    def _read(self, job_id: str, suffix: str) -> dict | None:
+        path = self._path(job_id, suffix)
+        if path is None:
+            return None
+        try:
+            with open(path, "rb") as file:
+                return orjson.loads(file.read())
+        except FileNotFoundError:
+            return None
+
+    def _delete(self, job_id: str) -> None:
+        for suffix in ("json.gz", "progress.json", "error.json", "job.json"):
+            try:
+                os.remove(self._path(job_id, suffix))
+            except FileNotFoundError:
+                pass
+
+
+def _write_json(path: str, content: dict) -> None:
+    # written aside and renamed, so readers never see a partial file
+    with open(path + ".tmp", "wb") as file:
+        file.write(dumps(content))
+    os.replace(path + ".tmp", path)
+
+
+def _glossed_report(params: dict) -> tuple[int, typing.Iterable]:
+    filters = period_filters(params["start"], params["end"])
+    filters["payment_status"] = "glossed"
+    if params["doctor_id"]:
+        filters["doctor_id"] = params["doctor_id"]
+
+    total = Procedure.count(replica=True, **filters)
+    batches = Procedure.stream_report(JOB_BATCH_SIZE, replica=True, **filters)
+    return total, (
+        list(row_dicts(batch, PROCEDURE_DETAIL_CONVERTERS)) for batch in batches
+    )
+
+
+def _financial_report(params: dict) -> tuple[int, typing.Iterable]:
+    rows = Procedure.get_financial_report(replica=True, **params)
+    return len(rows), [list(row_dicts(rows))]
+
+
+REPORTS = {"glossed": _glossed_report, "financial": _financial_report}
+
+
+def run_report_job(path: str, report: str, params: dict) -> int:
+    """
+    Run a report job in a worker, writing its progress and its result to
+    the files starting with `path`. Returns the number of rows.
+    """
+    try:
+        with session_scope():
+            total, batches = REPORTS[report](params)
+            rows = 0
+            _write_json(path + "progress.json", {"rows": rows, "total": total})
+
+            with gzip.open(path + "json.gz.tmp", "wb", compresslevel=6) as file:
+                file.write(b"[")
+                for batch in batches:
+                    for row in batch:
+                        file.write(b"," + dumps(row) if rows else dumps(row))
+                        rows += 1
+                    progress = {"rows": rows, "total": total}
+                    _write_json(path + "progress.json", progress)
+                file.write(b"]")
+            os.replace(path + "json.gz.tmp", path + "json.gz")
+    except Exception:
+        # the details stay in the log, they may hold SQL and parameters
+        logger.exception("Report job %s failed", path)
+        _write_json(path + "error.json", {"message": "The report failed."})
+        return 0
+    return rows
+
+
+REPORT_JOBS = ReportJobs(
+    directory=os.getenv(
+        "REPORT_JOB_DIR", os.path.join(tempfile.gettempdir(), "report_jobs")
+    ),
+    workers=int(os.getenv("REPORT_JOB_WORKERS", 2)),
+    executor=os.getenv("REPORT_JOB_EXECUTOR", "thread"),
+    ttl=float(os.getenv("REPORT_JOB_TTL", 3600)),
+)
@@ -2,11 +2,12 @@ import os
 
 from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlalchemy import Boolean, Column, Integer, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import Boolean, Column, Integer, String, event, inspect, select
+from sqlalchemy.orm import object_session, relationship
 
-from .auth import IAuth
+from .auth import IAuth, mark_principals_changed
 from .base import Base
+from .doctor import Doctor
 
 PWD_CONTEXT = CryptContext(schemes=["bcrypt"], deprecated="auto")
 SECRET_KEY = os.getenv("SECRET_KEY")
@@ -28,6 +29,10 @@ class UserDetail(BaseModel):
     is_superuser: bool | None = None
 
 
+class Principal(UserDetail):
+    doctor_id: int | None = None
+
+
 class UserInDB(UserDetail):
     hashed_password: str
 
@@ -59,10 +64,27 @@ class User(Base, IAuth):
 
         return user
 
+    @classmethod
+    async def aauthenticate_user(cls, username: str, password: str) -> UserInDB | bool:
+        user: UserInDB | bool = await cls.aget_by_username(username)
+
+        if not user:
+            return False
+        if not await cls.averify_password(password, user.hashed_password):
+            return False
+
+        return user
+
     @classmethod
     def get_by_username(cls, username: str) -> UserInDB | bool:
-        user: User | None = cls.filter(username=username).first()
+        return cls._to_user_in_db(cls.filter(username=username).first())
 
+    @classmethod
+    async def aget_by_username(cls, username: str) -> UserInDB | bool:
+        return cls._to_user_in_db(await cls.afirst(username=username))
+
+    @staticmethod
+    def _to_user_in_db(user: "User | None") -> UserInDB | bool:
         if not user:
             return False
 
@@ -72,3 +94,30 @@ class User(Base, IAuth):
             is_superuser=user.is_superuser,
             hashed_password=user.password,
         )
+
+    @classmethod
+    async def aget_principal(cls, username: str) -> Principal | bool:
+        rows = await cls.afetch(
+            select(
+                cls.id,
+                cls.username,
+                cls.is_superuser,
+                Doctor.id.label("doctor_id"),
+            )
+            .outerjoin(Doctor, Doctor.user_id == cls.id)
+            .where(cls.username == username)
+            .limit(1)
+        )
+
+        if not rows:
+            return False
+
+        return Principal(**rows[0]._mapping)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_principal(mapper, connection, target: User) -> None:
+    # the token subject is the username before a rename
+    usernames = {target.username, *inspect(target).attrs.username.history.deleted}
+    mark_principals_changed(object_session(target), usernames=usernames)
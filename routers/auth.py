@@ -22,7 +22,7 @@ router = APIRouter(
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ) -> Token:
-    user = User.authenticate_user(form_data.username, form_data.password)
+    user = await User.aauthenticate_user(form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -51,7 +51,7 @@ async def create_user(user: UserCreate) -> UserDetail:
             * username: Username of the user\n
             * is_superuser: Is the user a superuser?\n
     """
-    db_user = User.get_by_username(user.username)
+    db_user = await User.aget_by_username(user.username)
     if db_user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -65,6 +65,6 @@ async def create_user(user: UserCreate) -> UserDetail:
         )
 
     db_user = User(**user.model_dump())
-    db_user.password = User.get_password_hash(user.password)
-    db_user.create()
+    db_user.password = await User.aget_password_hash(user.password)
+    await db_user.acreate()
     return UserDetail(username=db_user.username, is_superuser=db_user.is_superuser)
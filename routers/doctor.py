@@ -7,6 +7,8 @@ from fastapi import APIRouter
 
 # from fastapi.responses import JSONResponse
 from models.doctor import Doctor, DoctorDetail, NewDoctor
+from models.user import User
+from validators.existence import check_references
 
 blueprint_name = "doctor"
 
@@ -19,6 +21,7 @@ router = APIRouter(
 
 @router.post("/registry", response_model=DoctorDetail)
 async def create_doctor(doctor: NewDoctor) -> DoctorDetail:
+    await check_references(doctor, {"user_id": User})
     doctor_instc = Doctor(**doctor.model_dump())
-    doctor_instc.create()
+    await doctor_instc.acreate()
     return doctor_instc
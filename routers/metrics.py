@@ -0,0 +1,16 @@
+from fastapi import APIRouter, Response
+
+from core.metrics import REGISTRY
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics() -> Response:
+    """
+    Get the metrics of this worker in the Prometheus text format.
+    """
+    return Response(
+        content=REGISTRY.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
@@ -31,5 +31,5 @@ class PatientDetail(NewPatient):
 @router.post("/registry", response_model=PatientDetail)
 async def create_patient(patient: NewPatient) -> PatientDetail:
     patient_instc = Patient(**patient.model_dump())
-    patient_instc.create()
+    await patient_instc.acreate()
     return patient_instc
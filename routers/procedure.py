@@ -1,17 +1,41 @@
-from datetime import date
-
-from fastapi import APIRouter, Depends
-from fastapi.responses import JSONResponse
-
+import csv
+import gzip
+import io
+import json
+import os
+import typing
+from contextlib import nullcontext
+from datetime import date, timedelta
+
+from fastapi import APIRouter, Depends, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from pydantic import ValidationError
+
+from core.responses import dump_rows, dumps, row_dicts
 from models.doctor import Doctor
+from models.patient import Patient
+from models.report_cache import REPORT_CACHE
+from models.report_jobs import REPORT_JOBS, ReportJob, ReportJobRequest
 from models.procedure import (
+    PROCEDURE_DETAIL_CONVERTERS,
+    BulkProcedure,
+    BreakdownDimension,
+    BulkProcedureResult,
+    ClinicFinancialReport,
+    FinancialBreakdown,
     FinancialReport,
     GlossedReport,
     NewProcedure,
     Procedure,
     ProcedureDetail,
+    ProcedureStatusResult,
+    ProcedureStatusUpdate,
+    ReportPeriod,
+    period_filters,
 )
-from models.user import User
+from models.user import Principal, User
+from validators.existence import check_references, get_existence_checker
 
 blueprint_name = "procedure"
 
@@ -23,6 +47,28 @@ router = APIRouter(
 
 USER_AUTH = User()
 
+# rows validated and inserted per transaction on the bulk registry
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", 1000))
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# keyset pagination and streaming of the procedure list reports
+DEFAULT_PAGE_SIZE = int(os.getenv("REPORT_PAGE_SIZE", 1000))
+MAX_PAGE_SIZE = 10000
+STREAM_BATCH_SIZE = int(os.getenv("REPORT_STREAM_BATCH_SIZE", 1000))
+# rows per Arrow record batch (Parquet row group) of the columnar export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 16384))
+
+# seconds the read replica may lag behind the primary
+REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", 5))
+
+ReportFormat = typing.Literal["json", "ndjson", "csv"]
+
+# POST paths honoring the Idempotency-Key header (IdempotencyMiddleware)
+IDEMPOTENT_PATHS = (
+    f"/{blueprint_name}/registry",
+    f"/{blueprint_name}/registry/bulk",
+)
+
 
 @router.post("/registry", response_model=ProcedureDetail)
 async def create_procedure(
@@ -32,6 +78,9 @@ async def create_procedure(
     """
     Create a new procedure.
 
+    Send an `Idempotency-Key` header to retry safely: a retry with the same
+    key gets the response of the first request, without creating it again.
+
     @JSON Params:\n
         - doctor_id: ID of the doctor\n
         - patient_id: ID of the patient\n
@@ -48,6 +97,8 @@ async def create_procedure(
             * value: Value of the procedure\n
             * payment_status: Payment status of the procedure (paid, pending, glossed)\n
     """
+    await check_references(procedure, {"doctor_id": Doctor, "patient_id": Patient})
+
     # if superuser, enable insetion withou checking doctor id
     if current_user.is_superuser:
         if not procedure.doctor_id or not procedure.patient_id:
@@ -57,90 +108,512 @@ async def create_procedure(
             )
 
         db_procedure = Procedure(**procedure.model_dump())
-        db_procedure.create()
+        await db_procedure.acreate()
         return db_procedure
 
     # is not a doctor
-    if not Doctor.exists(user_id=current_user.id):
+    if not current_user.doctor_id:
         return JSONResponse(
             status_code=400,
             content={"message": "Doctor not found."},
         )
 
     # change procedure ID to the current doctor ID
-    procedure.doctor_id = Doctor.get_by_user_id(user_id=current_user.id).id
+    procedure.doctor_id = current_user.doctor_id
     db_procedure = Procedure(**procedure.model_dump())
-    db_procedure.create()
+    await db_procedure.acreate()
     return db_procedure
 
 
+@router.post(
+    "/registry/bulk",
+    response_model=list[BulkProcedureResult],
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "type": "array",
+                        "items": BulkProcedure.model_json_schema(),
+                    }
+                },
+                NDJSON_MEDIA_TYPE: {"schema": BulkProcedure.model_json_schema()},
+            },
+        }
+    },
+)
+async def create_procedures_bulk(
+    request: Request,
+    current_user: dict = Depends(USER_AUTH.get_current_user),
+) -> list[BulkProcedureResult]:
+    """
+    Create procedures in bulk.
+
+    The body can be a JSON array or NDJSON (`Content-Type: application/x-ndjson`,
+    one procedure per line), which is processed while it is streamed.
+    Rows are validated and inserted in chunks, one transaction per chunk.
+    The same rules of `/registry` apply: non superusers can only create
+    procedures for their own doctor. The `Idempotency-Key` header works like
+    on `/registry`; with it, all the chunks are committed together, so a
+    failed request saved nothing and can be retried with its key.
+
+    @JSON Params:\n
+        - list of procedures, with the same keys of `/registry`\n
+
+    @Return:\n
+        - BulkProcedureResult: Result of each row, in the order sent\n
+            * index: Position of the row in the body\n
+            * status: created or error\n
+            * id: ID of the created procedure\n
+            * error: Why the row was not created\n
+    """
+    # is not a doctor
+    if not current_user.is_superuser and not current_user.doctor_id:
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Doctor not found."},
+        )
+
+    transaction = (
+        Procedure.aunit_of_work()
+        if "Idempotency-Key" in request.headers
+        else nullcontext()
+    )
+    async with transaction:
+        try:
+            results = []
+            chunk = []
+            async for row in _read_bulk_rows(request):
+                chunk.append(row)
+                if len(chunk) >= BULK_CHUNK_SIZE:
+                    results += await run_in_threadpool(
+                        _create_bulk_chunk, chunk, len(results), current_user
+                    )
+                    chunk = []
+        except ValueError as error:
+            return JSONResponse(status_code=400, content={"message": str(error)})
+
+        if chunk:
+            results += await run_in_threadpool(
+                _create_bulk_chunk, chunk, len(results), current_user
+            )
+    return results
+
+
+async def _read_bulk_rows(request: Request):
+    """
+    Yield the rows of a JSON array body, or the lines of a NDJSON body
+    as they arrive.
+    """
+    content_type = request.headers.get("content-type", "")
+    if not content_type.startswith(NDJSON_MEDIA_TYPE):
+        try:
+            rows = await request.json()
+        except json.JSONDecodeError:
+            raise ValueError("Body must be a JSON array of procedures.")
+        if not isinstance(rows, list):
+            raise ValueError("Body must be a JSON array of procedures.")
+
+        for row in rows:
+            yield row
+        return
+
+    buffer = b""
+    async for data in request.stream():
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+def _create_bulk_chunk(
+    rows: list, start: int, current_user: Principal
+) -> list[BulkProcedureResult]:
+    """
+    Validate and insert a chunk of the bulk registry.
+
+    Doctor and patient ids are resolved with one query each for the chunk.
+    """
+    results = {}
+    procedures: list[tuple[int, BulkProcedure]] = []
+    for index, row in enumerate(rows, start):
+        try:
+            if isinstance(row, bytes):
+                procedure = BulkProcedure.model_validate_json(row)
+            else:
+                procedure = BulkProcedure.model_validate(row)
+        except ValidationError as error:
+            results[index] = BulkProcedureResult(
+                index=index, status="error", error=_format_validation_error(error)
+            )
+            continue
+
+        # change procedure ID to the current doctor ID
+        if not current_user.is_superuser:
+            procedure.doctor_id = current_user.doctor_id
+        procedures.append((index, procedure))
+
+    checker = get_existence_checker()
+    doctor_ids = checker.resolve(Doctor, (p.doctor_id for _, p in procedures))
+    patient_ids = checker.resolve(Patient, (p.patient_id for _, p in procedures))
+
+    to_create: list[tuple[int, BulkProcedure]] = []
+    for index, procedure in procedures:
+        error = None
+        if procedure.doctor_id not in doctor_ids:
+            error = f"Doctor with id {procedure.doctor_id} does not exist."
+        elif procedure.patient_id not in patient_ids:
+            error = f"Patient with id {procedure.patient_id} does not exist."
+
+        if error:
+            results[index] = BulkProcedureResult(
+                index=index, status="error", error=error
+            )
+        else:
+            to_create.append((index, procedure))
+
+    ids = Procedure.bulk_create([p.model_dump() for _, p in to_create])
+    for (index, _), procedure_id in zip(to_create, ids):
+        results[index] = BulkProcedureResult(
+            index=index, status="created", id=procedure_id
+        )
+
+    return [results[index] for index in sorted(results)]
+
+
+def _format_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(map(str, e['loc'])) or 'row'}: {e['msg']}"
+        for e in error.errors()
+    )
+
+
+@router.patch("/status", response_model=ProcedureStatusResult)
+async def update_procedures_status(
+    data: ProcedureStatusUpdate,
+    current_user: dict = Depends(USER_AUTH.get_current_user),
+) -> ProcedureStatusResult:
+    """
+    Change the payment status of procedures in bulk.
+
+    Non superusers can only change procedures of their own doctor.
+
+    @JSON Params:\n
+        - payment_status: New payment status (paid, pending, glossed)\n
+        - ids: IDs of the procedures (optional)\n
+        - doctor_id: ID of the doctor (optional)\n
+        - start: First day of the period (optional)\n
+        - end: Last day of the period (optional)\n
+        - current_status: Only change procedures with this status (optional)\n
+
+    @Return:\n
+        - ProcedureStatusResult\n
+            * updated: Number of updated procedures\n
+            * ids: IDs of the updated procedures\n
+    """
+    doctor_id = data.doctor_id
+    if not current_user.is_superuser:
+        # is not a doctor
+        if not current_user.doctor_id:
+            return JSONResponse(
+                status_code=400,
+                content={"message": "Doctor not found."},
+            )
+
+        doctor_id = current_user.doctor_id
+
+    filters = {"doctor_id": doctor_id} if doctor_id else {}
+    if data.ids is not None:
+        filters["id__in"] = data.ids
+    if data.start:
+        filters["date__gte"] = data.start
+    # end day included
+    if data.end:
+        filters["date__lt"] = data.end + timedelta(days=1)
+
+    ids = await run_in_threadpool(
+        Procedure.update_status,
+        data.payment_status,
+        current_status=data.current_status,
+        chunk_size=BULK_CHUNK_SIZE,
+        **filters,
+    )
+    return ProcedureStatusResult(updated=len(ids), ids=ids)
+
+
 @router.get("/report/daily", response_model=list[ProcedureDetail])
 async def get_daily_report(
     doctor_id: int | None = None,
+    limit: int | None = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    format: ReportFormat = "json",
     current_user: dict = Depends(USER_AUTH.get_current_user),
 ) -> list[ProcedureDetail]:
     """
     Get daily report of procedures by doctor.
+
+    @Query Params:\n
+        - limit: Page size. Paginates the report by keyset; the next page\n
+            cursor is sent in the `X-Next-Cursor` header\n
+        - cursor: Cursor of the page to get\n
+        - format: json (default), ndjson or csv. ndjson and csv are streamed\n
     """
-    current_doctor = Doctor.get_by_user_id(user_id=current_user.id)
+    current_doctor_id = current_user.doctor_id
 
     # if super user, check if is a doctor or selected some doctor
     if current_user.is_superuser:
-        if not doctor_id and not current_doctor:
+        if not doctor_id and not current_doctor_id:
             return JSONResponse(
                 status_code=400,
                 content={"message": "Doctor is required."},
             )
 
         if not doctor_id:
-            doctor_id = current_doctor.id
-        return Procedure.filter(date=date.today(), doctor_id=doctor_id)
+            doctor_id = current_doctor_id
+        return await _report_response(
+            limit,
+            cursor,
+            format,
+            ("daily", doctor_id, date.today(), date.today()),
+            **_today_filters(),
+            doctor_id=doctor_id,
+        )
 
-    if not current_doctor:
+    if not current_doctor_id:
         return JSONResponse(
             status_code=404,
             content={"message": "Doctor not found."},
         )
 
-    return Procedure.filter(date=date.today(), doctor_id=current_doctor.id)
+    return await _report_response(
+        limit,
+        cursor,
+        format,
+        ("daily", current_doctor_id, date.today(), date.today()),
+        **_today_filters(),
+        doctor_id=current_doctor_id,
+    )
+
+
+def _today_filters() -> dict:
+    return period_filters(date.today(), date.today())
 
 
 @router.post("/report/glossed", response_model=list[ProcedureDetail])
 async def get_glossed_report(
     data: GlossedReport,
     doctor_id: int | None = None,
+    limit: int | None = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    format: ReportFormat = "json",
     current_user: dict = Depends(USER_AUTH.get_current_user),
 ) -> list[ProcedureDetail]:
     """
     Get glossed report of procedures by period.
+
+    @Query Params:\n
+        - doctor_id: ID of the doctor\n
+        - limit: Page size. Paginates the report by keyset; the next page\n
+            cursor is sent in the `X-Next-Cursor` header\n
+        - cursor: Cursor of the page to get\n
+        - format: json (default), ndjson or csv. ndjson and csv are streamed\n
     """
-    current_doctor = Doctor.get_by_user_id(user_id=current_user.id)
+    current_doctor_id = current_user.doctor_id
 
     # check if is search by doctor
     if doctor_id:
-        if not current_doctor:
+        if not current_doctor_id:
             return JSONResponse(
                 status_code=404,
                 content={"message": "Doctor not found."},
             )
 
         if not current_user.is_superuser:
-            doctor_id = current_doctor.id
-
-        return Procedure.filter(
-            date__range=(data.start, data.end),
-            doctor_id=current_doctor.id,
+            doctor_id = current_doctor_id
+
+        return await _report_response(
+            limit,
+            cursor,
+            format,
+            ("glossed", doctor_id, data.start, data.end),
+            **period_filters(data.start, data.end),
+            doctor_id=doctor_id,
             payment_status="glossed",
         )
 
-    return Procedure.filter(
-        date__range=(data.start, data.end), payment_status="glossed"
+    return await _report_response(
+        limit,
+        cursor,
+        format,
+        ("glossed", None, data.start, data.end),
+        **period_filters(data.start, data.end),
+        payment_status="glossed",
+    )
+
+
+async def _report_response(
+    limit: int | None,
+    cursor: str | None,
+    format: ReportFormat,
+    cache_key: tuple,
+    **filters,
+):
+    """
+    Build the response of a procedure list report: streamed, paginated or
+    the whole report at once (served from the report cache).
+    """
+    if format != "json":
+        replica, _ = _replica_routing(filters.get("doctor_id"))
+        return _stream_report(format, replica, **filters)
+
+    if limit is None and cursor is None:
+        return await _cached_report(
+            cache_key,
+            lambda replica: Procedure.afetch(
+                Procedure.report_query(**filters), replica
+            ),
+            PROCEDURE_DETAIL_CONVERTERS,
+        )
+
+    replica, _ = _replica_routing(filters.get("doctor_id"))
+    try:
+        rows, next_cursor = await Procedure.aget_report_page(
+            cursor, limit or DEFAULT_PAGE_SIZE, replica, **filters
+        )
+    except ValueError as error:
+        return JSONResponse(status_code=400, content={"message": str(error)})
+
+    return Response(
+        content=dump_rows(rows, PROCEDURE_DETAIL_CONVERTERS),
+        media_type="application/json",
+        headers={"X-Next-Cursor": next_cursor} if next_cursor else None,
+    )
+
+
+async def _cached_report(
+    key: tuple, fetch, converters: dict | None = None
+) -> Response:
+    """
+    Serve a report from the report cache, running `fetch` on a miss.
+
+    `fetch` gets whether to read the replica. Its Core rows are serialized
+    directly, with `converters` matching them to the response model.
+    """
+    body = REPORT_CACHE.get(key)
+    if body is None:
+        generation = REPORT_CACHE.generation
+        replica, cacheable = _replica_routing(key[1])
+        rows = await fetch(replica)
+        body = dump_rows(rows, converters)
+        if cacheable:
+            REPORT_CACHE.set(key, body, generation)
+    return Response(content=body, media_type="application/json")
+
+
+def _replica_routing(doctor_id: int | None) -> tuple[bool, bool]:
+    """
+    Get if a report reads the replica and if its result can be cached.
+
+    A doctor changed within REPLICA_MAX_LAG is read from the primary, so
+    the changes show right away. The reports of every doctor change too
+    often to be pinned: they read the replica, and are only cached once it
+    had time to catch up. Without a replica, both go to the primary.
+    """
+    fresh = not REPORT_CACHE.changed_within(doctor_id, REPLICA_MAX_LAG)
+    if doctor_id is None:
+        return True, fresh
+    return fresh, True
+
+
+def _stream_report(
+    format: ReportFormat, replica: bool, **filters
+) -> StreamingResponse:
+    # one chunk per database batch; StreamingResponse pulls them in the
+    # threadpool, so the sync cursor does not block the event loop
+    batches = Procedure.stream_report(
+        batch_size=STREAM_BATCH_SIZE, replica=replica, **filters
+    )
+
+    if format == "ndjson":
+        content = (
+            b"".join(
+                dumps(row) + b"\n"
+                for row in row_dicts(batch, PROCEDURE_DETAIL_CONVERTERS)
+            )
+            for batch in batches
+        )
+        return StreamingResponse(content, media_type=NDJSON_MEDIA_TYPE)
+
+    return StreamingResponse(
+        _csv_lines(batches),
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=procedures.csv"},
+    )
+
+
+def _csv_lines(batches):
+    fields = list(ProcedureDetail.model_fields)
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    yield buffer.getvalue()
+
+    for batch in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            ProcedureDetail.model_validate(row).model_dump(mode="json")
+            for row in batch
+        )
+        yield buffer.getvalue()
+
+
+@router.get("/report/financial", response_model=list[ClinicFinancialReport])
+async def get_clinic_financial_report(
+    start: date | None = None,
+    end: date | None = None,
+    period: ReportPeriod = "month",
+    current_user: dict = Depends(USER_AUTH.get_current_user),
+) -> list[ClinicFinancialReport]:
+    """
+    Get financial report of every doctor, only for superusers.
+
+    @Query Params:\n
+        - start: First day of the period (optional)\n
+        - end: Last day of the period (optional)\n
+        - period: Group the totals by day, week or month (default)\n
+
+    @Return:\n
+        - ClinicFinancialReport: Totals by doctor, period and status\n
+            * doctor_id: ID of the doctor\n
+            * period: First day of the day, week (monday) or month\n
+            * total_value: Total value of the procedures\n
+            * procedures: Number of procedures\n
+            * status: Status of the payment (paid, pending, glossed)\n
+    """
+    if not current_user.is_superuser:
+        return JSONResponse(
+            status_code=403,
+            content={"message": "Only superusers can see the clinic report."},
+        )
+
+    return await _cached_report(
+        (f"clinic_financial_{period}", None, start, end),
+        lambda replica: Procedure.aget_financial_report(
+            start=start, end=end, period=period, replica=replica
+        ),
     )
 
 
 @router.get("/report/financial/{doctor_id}", response_model=list[FinancialReport])
 async def get_financial_report(
     doctor_id: int,
+    start: date | None = None,
+    end: date | None = None,
     current_user: dict = Depends(USER_AUTH.get_current_user),
 ) -> list[FinancialReport]:
     """
@@ -149,29 +622,243 @@ async def get_financial_report(
     @JSON Params:\n
         - doctor_id: ID of the doctor\n
 
+    @Query Params:\n
+        - start: First day of the period (optional)\n
+        - end: Last day of the period (optional)\n
+
     @Return:\n
         - FinancialReport: Financial report of the doctor\n
             * total_value: Total value of the procedures\n
             * procedures: Number of procedures\n
             * status: Status of the payment (paid, pending, glossed)\n
     """
-    current_doctor = Doctor.get_by_user_id(user_id=current_user.id)
+    current_doctor_id = current_user.doctor_id
 
     if current_user.is_superuser:
-        if not doctor_id and not current_doctor:
+        if not doctor_id and not current_doctor_id:
             return JSONResponse(
                 status_code=400,
                 content={"message": "Doctor is required."},
             )
 
         if not doctor_id:
-            doctor_id = current_doctor.id
-        return Procedure.get_financial_report(doctor_id=doctor_id)
+            doctor_id = current_doctor_id
+        return await _cached_financial_report(doctor_id, start, end)
 
-    if doctor_id != current_doctor.id:
+    if doctor_id != current_doctor_id:
         return JSONResponse(
             status_code=404,
             content={"message": "Doctor not found."},
         )
 
-    return Procedure.get_financial_report(doctor_id=doctor_id)
+    return await _cached_financial_report(doctor_id, start, end)
+
+
+async def _cached_financial_report(
+    doctor_id: int, start: date | None, end: date | None
+) -> Response:
+    return await _cached_report(
+        ("financial", doctor_id, start, end),
+        lambda replica: Procedure.aget_financial_report(
+            doctor_id=doctor_id, start=start, end=end, replica=replica
+        ),
+    )
+
+
+@router.get("/report/breakdown", response_model=list[FinancialBreakdown])
+async def get_financial_breakdown(
+    by: list[BreakdownDimension] = Query(["doctor_id", "status"]),
+    doctor_id: int | None = None,
+    status: typing.Literal["paid", "pending", "glossed"] | None = None,
+    start: date | None = None,
+    end: date | None = None,
+    percentiles: list[float] = Query([0.5, 0.9]),
+    current_user: dict = Depends(USER_AUTH.get_current_user),
+) -> list[FinancialBreakdown]:
+    """
+    Get the totals, glosa rate and value percentiles of the procedures
+    grouped by any of doctor, status, month and patient. Computed in
+    memory, from procedures refreshed every few seconds.
+
+    @Query Params:\n
+        - by: Dimensions to group by, repeat the parameter for each one\n
+            (default doctor_id and status)\n
+        - doctor_id: ID of the doctor. Regular users only see their own\n
+        - status: Status of the payment (paid, pending, glossed)\n
+        - start: First day of the period (optional)\n
+        - end: Last day of the period (optional)\n
+        - percentiles: Fractions from 0 to 1 (default 0.5 and 0.9)\n
+
+    @Return:\n
+        - FinancialBreakdown: the dimensions of the group, procedures,\n
+            total_value, glossed_value, glosa_rate (glossed / total value)\n
+            and the percentiles of the value (e.g. p50)\n
+    """
+    if not current_user.is_superuser:
+        if not current_user.doctor_id:
+            return JSONResponse(
+                status_code=404,
+                content={"message": "Doctor not found."},
+            )
+        doctor_id = current_user.doctor_id
+
+    if any(not 0 <= fraction <= 1 for fraction in percentiles):
+        return JSONResponse(
+            status_code=400,
+            content={"message": "Percentiles must be between 0 and 1."},
+        )
+
+    # numpy is only imported by the breakdown, to keep the startup fast
+    from models.procedure_aggregates import PROCEDURE_AGGREGATES
+
+    await run_in_threadpool(PROCEDURE_AGGREGATES.sync)
+    rows = await run_in_threadpool(
+        PROCEDURE_AGGREGATES.breakdown,
+        list(dict.fromkeys(by)),
+        doctor_id,
+        status,
+        start,
+        end,
+        percentiles,
+    )
+    return Response(content=dumps(rows), media_type="application/json")
+
+
+@router.get("/export")
+async def export_procedures(
+    format: typing.Literal["arrow", "parquet"] = "parquet",
+    doctor_id: int | None = None,
+    status: typing.Literal["paid", "pending", "glossed"] | None = None,
+    start: date | None = None,
+    end: date | None = None,
+    current_user: dict = Depends(USER_AUTH.get_current_user),
+) -> StreamingResponse:
+    """
+    Export the procedures in a columnar format for analytics, streamed in
+    record batches. Regular users only export their own procedures.
+
+    @Query Params:\n
+        - format: parquet (default) or arrow (IPC stream)\n
+        - doctor_id: ID of the doctor (optional for superusers)\n
+        - status: Status of the payment (paid, pending, glossed)\n
+        - start: First day of the period (optional)\n
+        - end: Last day of the period (optional)\n
+    """
+    if not current_user.is_superuser:
+        if not current_user.doctor_id:
+            return JSONResponse(
+                status_code=404,
+                content={"message": "Doctor not found."},
+            )
+        doctor_id = current_user.doctor_id
+
+    # pyarrow is only imported by the exports, to keep the startup fast
+    from models.procedure_export import MEDIA_TYPES, export_filters, iter_export
+
+    replica, _ = _replica_routing(doctor_id)
+    content = iter_export(
+        format,
+        EXPORT_BATCH_SIZE,
+        replica,
+        **export_filters(doctor_id, status, start, end),
+    )
+    return StreamingResponse(
+        content,
+        media_type=MEDIA_TYPES[format],
+        headers={
+            "Content-Disposition": f"attachment; filename=procedures.{format}"
+        },
+    )
+
+
+@router.post("/report/jobs", response_model=ReportJob, status_code=202)
+async def submit_report_job(
+    data: ReportJobRequest,
+    current_user: dict = Depends(USER_AUTH.get_current_user),
+) -> ReportJob:
+    """
+    Run a glossed or financial report in the background, for periods too
+    long to be answered inline. Poll the job until it is done, then get
+    its result. An identical job already running is reused.
+
+    @JSON Params:\n
+        - report: glossed or financial\n
+        - doctor_id: ID of the doctor. Only superusers may leave it empty,
+            for every doctor, or choose another doctor\n
+        - start, end: Period of the report (required for glossed)\n
+        - period: Group the financial totals by day, week or month\n
+    """
+    if not current_user.is_superuser:
+        if not current_user.doctor_id:
+            return JSONResponse(
+                status_code=404,
+                content={"message": "Doctor not found."},
+            )
+        data.doctor_id = current_user.doctor_id
+
+    job_id = await run_in_threadpool(REPORT_JOBS.submit, data.report, data.params())
+    return await run_in_threadpool(REPORT_JOBS.status, job_id)
+
+
+@router.get("/report/jobs/{job_id}", response_model=ReportJob)
+async def get_report_job(
+    job_id: str,
+    current_user: dict = Depends(USER_AUTH.get_current_user),
+) -> ReportJob:
+    """
+    Get the status and progress of a report job.
+
+    @Return:\n
+        - ReportJob: status (pending, running, done, failed), the rows\n
+            written so far, the total and their ratio (progress)\n
+    """
+    job = await run_in_threadpool(REPORT_JOBS.status, job_id)
+    if not _can_see_job(job, current_user):
+        return JSONResponse(status_code=404, content={"message": "Job not found."})
+    return job
+
+
+@router.get("/report/jobs/{job_id}/result")
+async def get_report_job_result(
+    job_id: str,
+    request: Request,
+    current_user: dict = Depends(USER_AUTH.get_current_user),
+):
+    """
+    Get the result of a finished report job, a JSON list of the rows of
+    the report. Sent gzipped when the client accepts it.
+    """
+    job = await run_in_threadpool(REPORT_JOBS.status, job_id)
+    if not _can_see_job(job, current_user):
+        return JSONResponse(status_code=404, content={"message": "Job not found."})
+
+    path = REPORT_JOBS.result_path(job_id)
+    if job["status"] != "done" or path is None:
+        return JSONResponse(
+            status_code=409,
+            content={"message": f"Job is {job['status']}."},
+        )
+
+    # stored gzipped, sent as is unless the client does not accept it
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return FileResponse(
+            path,
+            media_type="application/json",
+            headers={"Content-Encoding": "gzip"},
+        )
+    return StreamingResponse(_gunzip(path), media_type="application/json")
+
+
+def _can_see_job(job: dict | None, current_user) -> bool:
+    if job is None:
+        return False
+    doctor_id = job["params"]["doctor_id"]
+    return current_user.is_superuser or (
+        doctor_id is not None and doctor_id == current_user.doctor_id
+    )
+
+
+def _gunzip(path: str, chunk_size: int = 64 * 1024):
+    with gzip.open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            yield chunk
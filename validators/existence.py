@@ -0,0 +1,155 @@
+import os
+
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel
+from sqlalchemy import event
+
+from models.base import Base
+from models.cache import TTLCache
+from models.engine import replica_url
+
+
+class ExistenceChecker:
+    """
+    Cached existence checks of records by id.
+
+    Found ids are cached for `ttl` seconds and missing ids for
+    `negative_ttl` seconds, so a record created right after a failed check
+    is soon accepted. Subclass and override `query` to change where the
+    ids are looked up.
+    """
+
+    def __init__(
+        self, maxsize: int = 65536, ttl: float = 300, negative_ttl: float = 5
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def exists(self, model: type[Base], id: int) -> bool:
+        """
+        Check if the record with the id exists.
+        """
+        return id in self.resolve(model, [id])
+
+    def resolve(self, model: type[Base], ids) -> set[int]:
+        """
+        Get which of the ids exist. The ids missing from the cache are
+        checked with a single `IN (...)` query.
+        """
+        found, unknown = self._cached(model, ids)
+        if unknown:
+            found |= self._query_unknown(model, unknown)
+        return found
+
+    async def aresolve(self, model: type[Base], ids) -> set[int]:
+        """
+        Async version of `resolve`: the query of the ids missing from the
+        cache runs in the threadpool, never on the event loop.
+        """
+        found, unknown = self._cached(model, ids)
+        if unknown:
+            found |= await run_in_threadpool(self._query_unknown, model, unknown)
+        return found
+
+    def _cached(self, model: type[Base], ids) -> tuple[set[int], list[int]]:
+        found = set()
+        unknown = []
+        for id in set(ids):
+            cached = self._cache.get((model.__tablename__, id))
+            if cached is None:
+                unknown.append(id)
+            elif cached:
+                found.add(id)
+        return found, unknown
+
+    def _query_unknown(self, model: type[Base], ids: list[int]) -> set[int]:
+        existing = self.query(model, ids)
+        for id in ids:
+            self._cache.set(
+                (model.__tablename__, id),
+                id in existing,
+                ttl=self.ttl if id in existing else self.negative_ttl,
+            )
+        return existing
+
+    def query(self, model: type[Base], ids: list[int]) -> set[int]:
+        if not replica_url():
+            return model.existing_ids(ids)
+
+        # the replica may lag behind: ids missing there are checked again
+        # on the primary, so a record created right before is accepted
+        existing = model.existing_ids(ids, replica=True)
+        missing = [id for id in ids if id not in existing]
+        if missing:
+            existing |= model.existing_ids(missing)
+        return existing
+
+    def invalidate(self, model: type[Base], id: int) -> None:
+        self._cache.invalidate((model.__tablename__, id))
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return self._cache.stats()
+
+
+_EXISTENCE_CHECKER = ExistenceChecker(
+    maxsize=int(os.getenv("EXISTENCE_CACHE_SIZE", 65536)),
+    ttl=float(os.getenv("EXISTENCE_CACHE_TTL", 300)),
+    negative_ttl=float(os.getenv("EXISTENCE_NEGATIVE_TTL", 5)),
+)
+
+
+def get_existence_checker() -> ExistenceChecker:
+    return _EXISTENCE_CHECKER
+
+
+async def check_references(body: BaseModel, fields: dict[str, type[Base]]) -> None:
+    """
+    Check that the records referenced by the ids of a request body exist,
+    raising the 422 of a failed body validation otherwise.
+
+    Called by the endpoints instead of field validators: FastAPI validates
+    the body on the event loop, where the existence queries would block.
+
+    @Params:
+        - body: Validated request body
+        - fields: Model referenced by each id field
+    """
+    checker = get_existence_checker()
+    errors = []
+    for field, model in fields.items():
+        id = getattr(body, field)
+        if id in await checker.aresolve(model, [id]):
+            continue
+
+        message = f"{model.__name__} with id {id} does not exist."
+        errors.append(
+            {
+                "type": "value_error",
+                "loc": ("body", field),
+                "msg": f"Value error, {message}",
+                "input": id,
+                "ctx": {"error": ValueError(message)},
+            }
+        )
+
+    if errors:
+        raise RequestValidationError(errors)
+
+
+def set_existence_checker(checker: ExistenceChecker) -> None:
+    """
+    Replace the existence checker used by the validators.
+    """
+    global _EXISTENCE_CHECKER
+    _EXISTENCE_CHECKER = checker
+
+
+@event.listens_for(Base, "after_insert", propagate=True)
+@event.listens_for(Base, "after_delete", propagate=True)
+def _invalidate_existence(mapper, connection, target: Base) -> None:
+    _EXISTENCE_CHECKER.invalidate(type(target), target.id)
@@ -1,43 +1,23 @@
-def doctor_exists(doctor_id: int) -> int:
+def positive_id(label: str):
     """
-    Check if a doctor exists in the database.
+    Get a validator of the ids that must be integers greater than 0.
 
-    @Params:
-        - doctor_id: ID of the doctor
-
-    @Return:
-        - True if the doctor exists, False otherwise
-    """
-    from models.doctor import Doctor
-
-    if not isinstance(doctor_id, int) or doctor_id <= 0:
-        raise ValueError("Doctor id must be an integer greater than 0.")
-
-    if not Doctor.exists(id=doctor_id):
-        raise ValueError(f"Doctor with id {doctor_id} does not exist.")
-
-    return doctor_id
-
-
-def patient_exists(patient_id: int) -> int:
-    """
-    Check if a patient exists in the database.
+    Whether the record exists is checked by the endpoints with
+    `validators.existence.check_references`, out of the event loop.
 
     @Params:
-        - patient_id: ID of the patient
+        - label: Name of the record in the error message
 
     @Return:
-        - True if the patient exists, False otherwise
+        - Validator returning the id
     """
-    from models.patient import Patient
-
-    if not isinstance(patient_id, int) or patient_id <= 0:
-        raise ValueError("Patient id must be an integer greater than 0.")
 
-    if not Patient.exists(id=patient_id):
-        raise ValueError(f"Patient with id {patient_id} does not exist.")
+    def validate(id: int) -> int:
+        if not isinstance(id, int) or id <= 0:
+            raise ValueError(f"{label} id must be an integer greater than 0.")
+        return id
 
-    return patient_id
+    return validate
 
 
 def value_is_number(value: float) -> float:
@@ -54,24 +34,3 @@ def value_is_number(value: float) -> float:
         raise ValueError("Value must be a number.")
 
     return value
-
-
-def user_exists(user_id: int) -> int:
-    """
-    Check if a user exists in the database.
-
-    @Params:
-        - user_id: ID of the user
-
-    @Return:
-        - True if the user exists, False otherwise
-    """
-    from models.user import User
-
-    if not isinstance(user_id, int) or user_id <= 0:
-        raise ValueError("User id must be an integer greater than 0.")
-
-    if not User.exists(id=user_id):
-        raise ValueError(f"User with id {user_id} does not exist.")
-
-    return user_id